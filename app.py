@@ -1,671 +1,1958 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Request, request, jsonify, make_response, send_file
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 import sqlite3
 import uuid
-import datetime
 import time
 import os
 import json
-import random
+import threading
+import socket
+import gzip
+import hashlib
+import bisect
+import tempfile
+import atexit
+import fcntl
+import queue
+from concurrent.futures import Future
+import base64
+import struct
+import sys
+import zlib
+from collections import OrderedDict, deque
 
-app = Flask(__name__)
+try: import redis
+except ImportError: redis = None
+try: import brotli
+except ImportError: brotli = None
+try: import orjson
+except ImportError: orjson = None
+
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'upload_attachment': return ATTACHMENT_MAX_BYTES
+        return super().max_content_length
+
+app = Flask(__name__, static_folder=None)
+app.request_class = AppRequest
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 
 
-DB_NAME = 'storage.db'
+DB_NAME = os.environ.get('DB_PATH', 'storage.db')
 ADMIN_CODE = os.environ.get('ADMIN_PASSWORD', 'admin888')
-FILE_URL = os.environ.get('FILE_URL', 'https://wj.agsy.hidns.vip/')
+MAX_CIPHERTEXT = 15000
+BINARY_MIME = 'application/octet-stream'
+BATCH_MAX = 50
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR', 'attachments')
+ATTACHMENT_MAX_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', 100 * 1024 * 1024))
+ATTACHMENT_CHUNK = 64 * 1024
+
+RATE_POLICIES = {
+    'create_temp': (1, 1 / 60),
+    'admin': (1, 1 / 3),
+    'message': (1, 1.0),
+    'upload': (3, 1 / 20),
+}
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'sqlite')
+RATE_DB_NAME = os.environ.get('RATE_DB_PATH', 'ratelimit.db')
+RATE_MAX_KEYS = int(os.environ.get('RATE_MAX_KEYS', 100000))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+POLL_WAIT_MAX = 25
+POLL_RECHECK = 4
+POLL_INTERVAL = 1.5
+POLL_QUIET_AFTER = 60
+POLL_DELAY_MAX = 15
+ROOM_SIGNALS = {}
+ROOM_SIGNALS_LOCK = threading.Lock()
+ROOM_LISTENERS = []
+
+MESSAGE_TTL = 300
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_ROOM_MAX_MESSAGES = int(os.environ.get('CACHE_ROOM_MAX_MESSAGES', 500))
+CACHE_ROOM_MAX_BYTES = int(os.environ.get('CACHE_ROOM_MAX_BYTES', 2 * 1024 * 1024))
+SEQUENCE_HOLD = 1
+SYNC_TIMEOUT = 2
+PRESENCE_TIMEOUT = 8
+PRESENCE_FLUSH = int(os.environ.get('PRESENCE_FLUSH', 30))
+EPHEMERAL_STORAGE = os.environ.get('EPHEMERAL_STORAGE', 'memory' if os.environ.get('EPHEMERAL_WRITE_THROUGH') == '0' else 'sqlite')
+EPHEMERAL_IN_MEMORY = EPHEMERAL_STORAGE == 'memory'
+CHAT_SHARDS = max(int(os.environ.get('CHAT_SHARDS', 1)), 1)
+RUN_KEY = hashlib.sha1(os.path.abspath(DB_NAME).encode()).hexdigest()[:8]
+BUS_DIR = os.environ.get('BUS_DIR', os.path.join(tempfile.gettempdir(), 'secret-note-bus-' + RUN_KEY))
+
+SWEEP_TICK = 5
+SWEEP_LEASE = 30
+SWEEP_BATCH = int(os.environ.get('SWEEP_BATCH', 500))
+SWEEP_TASKS = {
+    'secrets': ('secrets', 'expire_at < ?', lambda now: (int(now),), int(os.environ.get('SWEEP_SECRETS_INTERVAL', 60))),
+    'chat_messages': ('chat_messages', 'created_at < ?', lambda now: (now - 300,), int(os.environ.get('SWEEP_MESSAGES_INTERVAL', 30))),
+    'rooms': ('rooms', 'is_public = 0 AND last_active < ?', lambda now: (now - 600,), int(os.environ.get('SWEEP_ROOMS_INTERVAL', 60))),
+    'attachments': ('attachments', 'expire_at < ?', lambda now: (int(now),), int(os.environ.get('SWEEP_ATTACHMENTS_INTERVAL', 60))),
+}
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 5))
+WAL_CHECKPOINT_BYTES = int(os.environ.get('WAL_CHECKPOINT_BYTES', 4 * 1024 * 1024))
+WAL_TRUNCATE_BYTES = int(os.environ.get('WAL_TRUNCATE_BYTES', 32 * 1024 * 1024))
+WAL_AUTOCHECKPOINT = 16384
+VACUUM_INTERVAL = int(os.environ.get('VACUUM_INTERVAL', 30))
+VACUUM_STEP_PAGES = int(os.environ.get('VACUUM_STEP_PAGES', 128))
+VACUUM_KEEP_FREE = int(os.environ.get('VACUUM_KEEP_FREE', 1024))
+VACUUM_BUDGET = 0.2
+BACKGROUND_PID = None
+BACKGROUND_LOCK = threading.Lock()
+
+METRICS_ENABLED = os.environ.get('METRICS', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'secret-note-metrics-' + RUN_KEY))
+METRICS_PREFIX = 'secret_note_'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+GAUGE_PROVIDERS = []
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+SLOW_QUERY_SECONDS = SLOW_QUERY_MS / 1000 if SLOW_QUERY_MS > 0 else float('inf')
+SLOW_QUERY_KEEP = 200
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'secret-note-profiles-' + RUN_KEY))
+PROFILE_MAX_SECONDS = 120
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION', '1') == '1'
+ADMISSION_TOTAL = int(os.environ.get('ADMISSION_TOTAL', 56))
+ADMISSION_WRITE_BACKLOG = int(os.environ.get('ADMISSION_WRITE_BACKLOG', 2000))
+ADMISSION_CLASSES = {
+    'send': (32, 1.0, 1),
+    'note': (32, 1.0, 1),
+    'heartbeat': (16, 1.0, 1),
+    'room': (16, 0.9, 2),
+    'poll': (48, 0.85, 2),
+    'upload': (4, 0.75, 5),
+    'list': (8, 0.6, 5),
+}
+for item in filter(None, os.environ.get('ADMISSION_LIMITS', '').split(',')):
+    name, limit = item.split('=')
+    ADMISSION_CLASSES[name.strip()] = (int(limit), *ADMISSION_CLASSES[name.strip()][1:])
+ROUTE_CLASSES = {
+    'send_chat': 'send', 'send_chat_batch': 'send',
+    'create_note_api': 'note', 'read_note_api': 'note', 'note_meta': 'note', 'read_attachment': 'note',
+    'create_public_room': 'room', 'create_temp_room': 'room', 'room_info': 'room', 'delete_room': 'room',
+    'room_heartbeat': 'heartbeat',
+    'poll_chat': 'poll', 'poll_chat_batch': 'poll',
+    'upload_attachment': 'upload',
+    'list_rooms': 'list',
+}
+
+GROUP_COMMIT_MS = float(os.environ.get('GROUP_COMMIT_MS', 5))
+GROUP_COMMIT_MAX = int(os.environ.get('GROUP_COMMIT_MAX', 256))
+
+DB_PRAGMAS = {'synchronous': 'NORMAL', 'temp_store': 'MEMORY', 'wal_autocheckpoint': WAL_AUTOCHECKPOINT, 'journal_size_limit': WAL_CHECKPOINT_BYTES}
+DB_TUNING = {
+    'notes': {'cache_size': -8000, 'mmap_size': 64 * 1024 * 1024},
+    'chat': {'cache_size': -4000, 'mmap_size': 32 * 1024 * 1024},
+}
+for item in filter(None, os.environ.get('DB_TUNING', '').split(',')):
+    key, value = item.split('=')
+    target, pragma = key.strip().rsplit('.', 1)
+    DB_TUNING.setdefault(target, {})[pragma] = value.strip()
+
+class Metrics:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        slot = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            hist[slot] += 1
+            hist[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            counters = [[name, labels, value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, list(hist)] for (name, labels), hist in self.histograms.items()]
+        gauges = [[name, labels, value] for provider in GAUGE_PROVIDERS for name, labels, value in provider()]
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def dump(self):
+        if not self.path: return
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        name = os.path.join(self.path, f'{os.getpid()}.json')
+        with open(name + '.tmp', 'w') as f: json.dump(self.snapshot(), f)
+        os.replace(name + '.tmp', name)
+
+    def collect(self):
+        if not self.path: return [self.snapshot()]
+        self.dump()
+        snapshots = []
+        for entry in os.listdir(self.path):
+            if not entry.endswith('.json'): continue
+            target = os.path.join(self.path, entry)
+            try:
+                os.kill(int(entry[:-5]), 0)
+                with open(target) as f: snapshots.append(json.load(f))
+            except ProcessLookupError:
+                try: os.unlink(target)
+                except OSError: pass
+            except (OSError, ValueError): pass
+        return snapshots
+
+METRICS = Metrics(METRICS_DIR)
+
+class TimedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counted = 0
+
+    def execute(self, sql, params=()):
+        return self.timed(super().execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self.timed(super().executemany, sql, params, True)
 
-CREATION_LIMITS = {}
-ADMIN_LIMITS = {}
-MESSAGE_LIMITS = {}
+    def commit(self):
+        return self.timed(lambda sql, params: sqlite3.Connection.commit(self), 'COMMIT', ())
+
+    def timed(self, run, sql, params, many=False):
+        op = (('op', sql.split(None, 1)[0].upper()),)
+        started = time.perf_counter()
+        try: return run(sql, params)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e): METRICS.inc('db_busy_total', op)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            METRICS.observe('db_statement_duration_seconds', op, elapsed)
+            if op[0][1] == 'BEGIN': METRICS.observe('db_lock_wait_seconds', (), elapsed)
+            if self.total_changes != self.counted:
+                METRICS.inc('db_rows_written_total', (), self.total_changes - self.counted)
+                self.counted = self.total_changes
+            if elapsed >= SLOW_QUERY_SECONDS: log_slow_query(self, sql, params, elapsed, many)
+
+SLOW_QUERIES = deque(maxlen=SLOW_QUERY_KEEP)
+QUERY_PLANS = OrderedDict()
+
+def query_plan(conn, sql, params):
+    key = ' '.join(sql.split())
+    plan = QUERY_PLANS.get(key)
+    if plan is None:
+        try: plan = '; '.join(row[3] for row in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params))
+        except sqlite3.Error as e: plan = f'unavailable: {e}'
+        QUERY_PLANS[key] = plan
+        if len(QUERY_PLANS) > SLOW_QUERY_KEEP: QUERY_PLANS.popitem(last=False)
+    return plan
+
+def log_slow_query(conn, sql, params, elapsed, many=False):
+    op = sql.split(None, 1)[0].upper()
+    if many: params = params[0] if isinstance(params, list) and params else ()
+    plan = query_plan(conn, sql, params) if op in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else ''
+    sql = ' '.join(sql.split())
+    SLOW_QUERIES.append({'at': time.time(), 'ms': round(elapsed * 1000, 3), 'sql': sql, 'plan': plan, 'thread': threading.current_thread().name})
+    METRICS.inc('db_slow_queries_total', (('op', op),))
+    app.logger.warning('slow query %.1fms: %s [plan: %s]', elapsed * 1000, sql, plan)
+
+class SamplingProfiler:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds, interval):
+        with self.lock:
+            if self.running: return None
+            self.running = True
+        name = f'{os.getpid()}-{int(time.time())}.folded'
+        threading.Thread(target=self.run, args=(name, seconds, interval), name='profiler', daemon=True).start()
+        return name
+
+    def sample(self, stacks, me):
+        names = {thread.ident: thread.name.replace(';', '_') for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me: continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            key = ';'.join([names.get(ident, 'thread'), *reversed(stack)])
+            stacks[key] = stacks.get(key, 0) + 1
+
+    def run(self, name, seconds, interval):
+        stacks = {}
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                self.sample(stacks, me)
+                time.sleep(interval)
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            target = os.path.join(self.path, name)
+            with open(target + '.tmp', 'w') as f: f.writelines(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+            os.replace(target + '.tmp', target)
+            for old in self.files()[20:]: os.unlink(os.path.join(self.path, old['name']))
+        except Exception as e: app.logger.warning('profiler: %s', e)
+        finally: self.running = False
+
+    def files(self):
+        try: entries = [entry for entry in os.scandir(self.path) if entry.name.endswith('.folded')]
+        except FileNotFoundError: return []
+        return sorted(({'name': entry.name, 'size': entry.stat().st_size, 'mtime': entry.stat().st_mtime} for entry in entries), key=lambda f: f['mtime'], reverse=True)
+
+PROFILER = SamplingProfiler(PROFILE_DIR)
+
+def db_path(name):
+    root, ext = os.path.splitext(DB_NAME)
+    return f'{root}-{name}{ext or ".db"}'
+
+class Database:
+    def __init__(self, name, path, profile, migrations):
+        self.name = name
+        self.path = path
+        self.pragmas = {**DB_PRAGMAS, **DB_TUNING[profile], **DB_TUNING.get(name, {})}
+        self.migrations = migrations
+        self.tables = set()
+        self.local = threading.local()
+        self.writer = GroupCommitWriter(self)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, cached_statements=256, factory=TimedConnection if METRICS_ENABLED or SLOW_QUERY_MS > 0 else sqlite3.Connection)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items(): conn.execute(f'PRAGMA {pragma} = {value};')
+        return conn
+
+    def conn(self):
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.conn = self.connect()
+            self.local.pid = pid
+        return self.local.conn
+
+    def release(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid() and conn.in_transaction: conn.rollback()
 
 def get_db():
-    conn = sqlite3.connect(DB_NAME, timeout=10)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return NOTES_DB.conn()
 
-def init_db():
-    conn = get_db()
-    conn.execute('PRAGMA journal_mode=WAL;')
-    conn.execute('PRAGMA auto_vacuum = FULL;')
+def table_columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+def migrate_base(conn):
     conn.execute('''CREATE TABLE IF NOT EXISTS secrets (id TEXT PRIMARY KEY, ciphertext TEXT, iv TEXT, salt TEXT, expire_at DATETIME, burn_mode INTEGER DEFAULT 1)''')
     conn.execute('''CREATE TABLE IF NOT EXISTS chat_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT, ciphertext TEXT, iv TEXT, created_at REAL, sender_id TEXT)''')
     conn.execute('''CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, name TEXT, is_public INTEGER, salt TEXT, created_at REAL, owner_token TEXT, last_active REAL)''')
-    try: conn.execute('ALTER TABLE secrets ADD COLUMN burn_mode INTEGER DEFAULT 1')
-    except: pass
-    try: conn.execute('ALTER TABLE chat_messages ADD COLUMN sender_id TEXT')
-    except: pass
-    try: conn.execute('ALTER TABLE rooms ADD COLUMN owner_token TEXT')
-    except: pass
-    try: conn.execute('ALTER TABLE rooms ADD COLUMN last_active REAL')
-    except: pass
-    conn.commit()
-    conn.close()
+    for table, column, decl in (('secrets', 'burn_mode', 'INTEGER DEFAULT 1'), ('chat_messages', 'sender_id', 'TEXT'), ('rooms', 'owner_token', 'TEXT'), ('rooms', 'last_active', 'REAL')):
+        if column not in table_columns(conn, table): conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
-init_db()
+def migrate_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_room_created ON chat_messages (room_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_created ON chat_messages (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rooms_public_created ON rooms (is_public, created_at, id, name, salt)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rooms_public_active ON rooms (is_public, last_active)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_secrets_expire ON secrets (expire_at)')
 
-def cleanup_memory_cache():
-    now = time.time()
-    for ip in list(CREATION_LIMITS.keys()):
-        if now - CREATION_LIMITS[ip] > 60: del CREATION_LIMITS[ip]
-    for ip in list(ADMIN_LIMITS.keys()):
-        if now - ADMIN_LIMITS[ip] > 5: del ADMIN_LIMITS[ip]
-    for ip in list(MESSAGE_LIMITS.keys()):
-        if now - MESSAGE_LIMITS[ip] > 5: del MESSAGE_LIMITS[ip]
-
-def clean_zombies():
+def migrate_sweeper(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sweep_stats (task TEXT PRIMARY KEY, runs INTEGER, purged INTEGER, last_purged INTEGER, last_run REAL, last_duration REAL)')
+
+def unbase64(val):
+    if not isinstance(val, str): return val
+    try: return base64.b64decode(val, validate=True)
+    except ValueError: return val
+
+def migrate_blobs(conn):
+    conn.create_function('unbase64', 1, unbase64, deterministic=True)
+    conn.execute("UPDATE secrets SET ciphertext = unbase64(ciphertext), iv = unbase64(iv), salt = unbase64(salt) WHERE typeof(ciphertext) = 'text'")
+    conn.execute("UPDATE chat_messages SET ciphertext = unbase64(ciphertext), iv = unbase64(iv) WHERE typeof(ciphertext) = 'text'")
+
+def migrate_epoch_expiry(conn):
+    conn.execute("UPDATE secrets SET expire_at = CAST(strftime('%s', expire_at, 'utc') AS INTEGER) WHERE typeof(expire_at) = 'text'")
+
+def migrate_attachments(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS attachments (id TEXT PRIMARY KEY, room_id TEXT, size INTEGER, expire_at INTEGER, burn_mode INTEGER DEFAULT 1)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_attachments_expire ON attachments (expire_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_attachments_room ON attachments (room_id)')
+
+def migrate_split(conn):
+    rooms = conn.execute('SELECT id, name, is_public, salt, created_at, owner_token, last_active FROM rooms WHERE is_public = 1').fetchall()
+    target = ROOMS_DB.connect()
     try:
-        conn = get_db()
-        now_dt = datetime.datetime.now()
-        now_ts = time.time()
-        conn.execute('DELETE FROM secrets WHERE expire_at < ?', (now_dt,))
-        conn.execute('DELETE FROM chat_messages WHERE created_at < ?', (now_ts - 300,))
-        conn.execute('DELETE FROM rooms WHERE is_public = 0 AND last_active < ?', (now_ts - 600,))
-        cleanup_memory_cache()
-        conn.commit()
+        target.executemany('INSERT OR IGNORE INTO rooms (id, name, is_public, salt, created_at, owner_token, last_active) VALUES (?,?,?,?,?,?,?)', rooms)
+        target.commit()
+    finally: target.close()
+    conn.execute('DROP TABLE rooms')
+    conn.execute('DROP TABLE chat_messages')
+
+MIGRATIONS = [migrate_base, migrate_indexes, migrate_sweeper, migrate_blobs, migrate_epoch_expiry, migrate_attachments, migrate_split]
+
+def migrate_chat(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, name TEXT, is_public INTEGER, salt TEXT, created_at REAL, owner_token TEXT, last_active REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS chat_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT, ciphertext BLOB, iv BLOB, created_at REAL, sender_id TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_room_created ON chat_messages (room_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_created ON chat_messages (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rooms_public_created ON rooms (is_public, created_at, id, name, salt)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rooms_public_active ON rooms (is_public, last_active)')
+
+CHAT_MIGRATIONS = [migrate_chat]
+
+def enable_incremental_vacuum(conn):
+    try:
+        if conn.execute('PRAGMA journal_mode=DELETE;').fetchone()[0] != 'delete': return
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        conn.execute('VACUUM')
+    except sqlite3.OperationalError as e: app.logger.warning('auto_vacuum conversion skipped: %s', e)
+    finally: conn.execute('PRAGMA journal_mode=WAL;')
+
+def init_db(db):
+    conn = sqlite3.connect(db.path, timeout=10, isolation_level=None)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    conn.execute('PRAGMA journal_mode=WAL;')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, migrate in enumerate(db.migrations[version:], version + 1):
+            migrate(conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2: enable_incremental_vacuum(conn)
+        db.tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
         conn.close()
-    except: pass
-
-def random_clean():
-    if random.random() < 0.01: clean_zombies()
-
-def validate_str(val, max_len=1000, default=""):
-    if not isinstance(val, str): return default
-    return val[:max_len]
-
-HTML_LAYOUT = r"""
-<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-    <title>加密传输系统</title>
-    <style>
-        :root { --bg: #0f172a; --panel: #1e293b; --text: #e2e8f0; --primary: #3b82f6; --danger: #ef4444; --success: #10b981; --msg-me: #2563eb; --msg-other: #334155; }
-        body { background: var(--bg); color: var(--text); font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; overflow: hidden; }
-        .container { padding: 20px; max-width: 600px; margin: auto; width: 100%; box-sizing: border-box; display: flex; flex-direction: column; max-height: 100vh; }
-        .panel { background: var(--panel); padding: 2rem; border-radius: 16px; box-shadow: 0 4px 20px rgba(0,0,0,0.4); margin-bottom: 20px; }
-        h2 { margin-top: 0; text-align: center; color: #fff; font-size: 1.5rem; }
-        h3 { color: #94a3b8; border-bottom: 1px solid #334155; padding-bottom: 10px; margin-top: 0; }
-        textarea, input, select { width: 100%; background: #334155; border: 1px solid #475569; color: white; padding: 12px; border-radius: 8px; margin: 10px 0; box-sizing: border-box; font-size: 16px; outline: none; }
-        .btn { width: 100%; padding: 14px; border: none; border-radius: 8px; font-size: 16px; font-weight: bold; cursor: pointer; margin-top: 10px; transition: 0.2s; text-align: center; display: inline-block; text-decoration: none; box-sizing: border-box; }
-        .btn-primary { background: var(--primary); color: white; }
-        .btn-danger { background: var(--danger); color: white; }
-        .btn-success { background: var(--success); color: white; }
-        .btn-secondary { background: #334155; color: #cbd5e1; }
-        .btn-sm { padding: 8px 15px; font-size: 14px; width: auto; margin-top: 0; }
-        .options { display: flex; gap: 10px; align-items: center; }
-        .hidden { display: none !important; }
-        .result-box { background: #0f172a; padding: 15px; border-radius: 8px; border: 1px dashed #475569; word-break: break-all; color: var(--primary); margin: 15px 0; font-family: monospace; display: none; }
-        .room-list { max-height: 300px; overflow-y: auto; display: flex; flex-direction: column; gap: 10px; }
-        .room-item { background: #334155; padding: 15px; border-radius: 8px; display: flex; justify-content: space-between; align-items: center; }
-        .room-info { display: flex; flex-direction: column; }
-        .room-name { font-weight: bold; color: white; }
-        .room-time { font-size: 12px; color: #94a3b8; margin-top: 4px; }
-        .toggle-wrapper { display: flex; align-items: center; justify-content: space-between; background: #334155; padding: 10px; border-radius: 8px; margin-top: 10px; border: 1px solid #475569; }
-        .switch { position: relative; display: inline-block; width: 50px; height: 24px; }
-        .switch input { opacity: 0; width: 0; height: 0; }
-        .slider { position: absolute; cursor: pointer; top: 0; left: 0; right: 0; bottom: 0; background-color: #64748b; transition: .4s; border-radius: 34px; }
-        .slider:before { position: absolute; content: ""; height: 16px; width: 16px; left: 4px; bottom: 4px; background-color: white; transition: .4s; border-radius: 50%; }
-        input:checked + .slider { background-color: var(--success); }
-        input:checked + .slider:before { transform: translateX(26px); }
-        #chat-view { display: flex; flex-direction: column; height: 100%; max-width: 800px; margin: 0 auto; width: 100%; background: var(--bg); position: fixed; top: 0; left: 0; right: 0; bottom: 0; z-index: 100; }
-        #chat-header { padding: 15px; background: var(--panel); border-bottom: 1px solid #334155; display: flex; justify-content: space-between; align-items: center; }
-        #chat-title { font-weight: bold; color: white; }
-        #chat-box { flex: 1; overflow-y: auto; padding: 20px; display: flex; flex-direction: column; gap: 15px; }
-        .msg-row { display: flex; width: 100%; }
-        .msg-row.me { justify-content: flex-end; }
-        .msg-bubble { max-width: 70%; padding: 10px 15px; border-radius: 12px; font-size: 15px; line-height: 1.5; word-wrap: break-word; position: relative; }
-        .me .msg-bubble { background: var(--msg-me); color: white; border-bottom-right-radius: 2px; }
-        .other .msg-bubble { background: var(--msg-other); color: #e2e8f0; border-bottom-left-radius: 2px; }
-        .media-placeholder { background: rgba(0,0,0,0.2); padding: 12px; border-radius: 8px; text-align: center; cursor: pointer; border: 1px dashed #64748b; transition: 0.2s; display: inline-block; width: 100%; box-sizing: border-box; }
-        .media-placeholder:hover { background: rgba(0,0,0,0.4); border-color: var(--primary); }
-        .msg-bubble img, .msg-bubble video { max-width: 100%; border-radius: 8px; margin-top: 5px; display: block; }
-        .msg-bubble a { color: #60a5fa; text-decoration: underline; }
-        .system-msg { text-align: center; color: #64748b; font-size: 12px; margin: 10px 0; }
-        #chat-input-area { padding: 15px; background: var(--panel); border-top: 1px solid #334155; display: flex; gap: 10px; }
-        #chat-msg-input { margin: 0; height: 50px; }
-        .footer { text-align: center; margin-top: 20px; font-size: 12px; color: #64748b; padding-bottom: 20px; }
-        .footer a { color: #64748b; text-decoration: none; border-bottom: 1px dashed #64748b; }
-        .modal { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.7); display: flex; justify-content: center; align-items: center; z-index: 50; }
-    </style>
-</head>
-<body>
-    <div id="home-view" class="container">
-        <div class="panel">
-            <h2>加密传输系统</h2>
-            <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px; margin-bottom: 20px;">
-                <button onclick="showNoteCreate()" class="btn btn-primary">✉️ 发送私密笔记</button>
-                <button onclick="createTempRoom()" class="btn btn-secondary">💬 临时私聊 (房主在线)</button>
-            </div>
-            <h3>🔴 公开聊天大厅</h3>
-            <div id="room-list" class="room-list"><div style="text-align:center; color:#64748b; padding:20px;">加载中...</div></div>
-            <button onclick="showCreateRoomModal()" class="btn btn-success" style="width:100%; margin-top:10px;">➕ 创建公开房间 (管理员)</button>
-            <button onclick="loadRooms()" class="btn btn-secondary btn-sm" style="width:100%; margin-top:10px;">↻ 刷新列表</button>
-        </div>
-        <div class="footer">&copy; 2025 <a href="https://github.com/sykin7/secret-note" target="_blank">项目主页</a></div>
-    </div>
-
-    <div id="create-room-modal" class="modal hidden">
-        <div class="panel" style="width: 90%; max-width: 400px;">
-            <h3>创建公开聊天室</h3>
-            <input type="text" id="new-room-name" placeholder="房间名称 (最多20字)" maxlength="20">
-            <input type="text" id="new-room-pass" placeholder="进房密码 (必填)" autocomplete="off">
-            <div style="border-top:1px dashed #475569; margin:10px 0;"></div>
-            <input type="password" id="admin-code" placeholder="管理员口令" autocomplete="off">
-            <div style="display:flex; gap:10px;">
-                <button onclick="createPublicRoom()" class="btn btn-success">确认创建</button>
-                <button onclick="closeModal('create-room-modal')" class="btn btn-secondary">取消</button>
-            </div>
-        </div>
-    </div>
-
-    <div id="note-wrapper" class="container hidden">
-        <div class="panel">
-            <div id="create-view">
-                <h2>创建私密笔记</h2>
-                <textarea id="content" placeholder="在此输入私密内容..." required style="height:120px"></textarea>
-                <div class="options">
-                    <select id="expiration" style="flex:1"><option value="1">1 小时后过期</option><option value="24" selected>24 小时后过期</option></select>
-                </div>
-                <div class="toggle-wrapper">
-                    <span style="font-size:14px; color:#fff">🔥 阅后即焚</span>
-                    <label class="switch"><input type="checkbox" id="burn-toggle" checked><span class="slider"></span></label>
-                </div>
-                <input type="text" id="password" placeholder="设置访问密码（可选）" autocomplete="off">
-                <button onclick="createNote()" class="btn btn-primary" id="create-btn">生成加密链接</button>
-                <button onclick="location.reload()" class="btn btn-secondary">返回大厅</button>
-            </div>
-            <div id="result-view" class="hidden">
-                <h2>链接已生成</h2>
-                <div class="result-box" id="share-link"></div>
-                <div style="text-align:center; margin: 20px 0;">
-                    <div style="margin-bottom:10px; color:#94a3b8; font-size:14px;">加密链接已就绪</div>
-                    <button onclick="copyNoteLink()" class="btn btn-success" style="width: auto; padding: 10px 20px;">🔗 一键复制私密链接</button>
-                </div>
-                <p id="password-reminder" class="hidden" style="color:#f59e0b; font-size:13px; text-align:center;">⚠️ 已设置密码，请务必告知对方！</p>
-                <button onclick="location.href='/'" class="btn btn-secondary">返回首页</button>
-            </div>
-            <div id="decrypt-view" class="hidden">
-                <h2 id="view-title" style="color:var(--danger)">私密笔记</h2>
-                <p id="view-desc" style="text-align:center;">正在请求解密...</p>
-                <div id="pass-input-area" class="hidden"><input type="text" id="decrypt-pass" placeholder="输入密码" autocomplete="off"></div>
-                <button onclick="fetchAndDecryptNote()" class="btn btn-danger" id="reveal-btn">立即查看</button>
-                <button onclick="location.href='/'" class="btn btn-secondary">返回首页</button>
-            </div>
-            <div id="content-view" class="hidden">
-                <h2>笔记内容</h2>
-                <textarea id="decrypted-content" readonly style="height:150px"></textarea>
-                <p id="burn-status" style="text-align:center; color:#ef4444; font-size:13px;"></p>
-                <button onclick="location.href='/'" class="btn btn-secondary">返回首页</button>
-            </div>
-        </div>
-    </div>
-
-    <div id="chat-view" class="hidden">
-        <div id="chat-header">
-            <div id="chat-title" style="font-size:14px; overflow:hidden; text-overflow:ellipsis; white-space:nowrap; max-width:60%;">🔒 加密聊天室</div>
-            <div style="display:flex; gap:10px;">
-                <button id="copy-link-btn" onclick="copyRoomLink()" class="btn btn-success btn-sm" style="display:none;">🔗 复制链接</button>
-                <button onclick="exitChat()" style="background:none; border:none; color:#ef4444; cursor:pointer; font-size:14px;">🚫 退出</button>
-            </div>
-        </div>
-        <div id="chat-box"><div class="system-msg">正在连接...</div></div>
-        <div id="chat-input-area">
-            <button onclick="window.open('__FILE_URL__', '_blank')" class="btn btn-secondary" style="width:auto; padding:0 15px; margin:0; margin-right:8px;" title="传文件">📂</button>
-            <input type="text" id="chat-msg-input" placeholder="输入消息..." onkeypress="if(event.keyCode==13) sendChatMsg()">
-            <button onclick="sendChatMsg()" class="btn btn-primary" style="width:60px; margin:0;">发送</button>
-        </div>
-    </div>
-
-    <script>
-        const myClientId = Math.random().toString(36).substring(2);
-        const path = window.location.pathname;
-
-        window.loadMedia = function(el, url, type) {
-            if (type === 'img') {
-                el.outerHTML = '<img src="' + url + '">';
-            } else if (type === 'video') {
-                el.outerHTML = '<video controls src="' + url + '"></video>';
-            }
-        };
-
-        async function getKey(password, salt) {
-            const enc = new TextEncoder();
-            const keyMaterial = await window.crypto.subtle.importKey("raw", enc.encode(password), "PBKDF2", false, ["deriveKey"]);
-            return window.crypto.subtle.deriveKey({ name: "PBKDF2", salt: salt, iterations: 100000, hash: "SHA-256" }, keyMaterial, { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
-        }
-        async function encryptData(text, key) {
-            const iv = window.crypto.getRandomValues(new Uint8Array(12));
-            const encoded = new TextEncoder().encode(text);
-            const encrypted = await window.crypto.subtle.encrypt({ name: "AES-GCM", iv: iv }, key, encoded);
-            return { ciphertext: arrayBufferToBase64(encrypted), iv: arrayBufferToBase64(iv) };
-        }
-        async function decryptData(encryptedBase64, ivBase64, key) {
-            const data = base64ToArrayBuffer(encryptedBase64);
-            const iv = base64ToArrayBuffer(ivBase64);
-            const decrypted = await window.crypto.subtle.decrypt({ name: "AES-GCM", iv: iv }, key, data);
-            return new TextDecoder().decode(decrypted);
-        }
-        function arrayBufferToBase64(buffer) {
-            let binary = '';
-            const bytes = new Uint8Array(buffer);
-            for (let i = 0; i < bytes.byteLength; i++) binary += String.fromCharCode(bytes[i]);
-            return window.btoa(binary);
-        }
-        function base64ToArrayBuffer(base64) {
-            const binary_string = window.atob(base64);
-            const len = binary_string.length;
-            const bytes = new Uint8Array(len);
-            for (let i = 0; i < len; i++) bytes[i] = binary_string.charCodeAt(i);
-            return bytes.buffer;
-        }
-
-        window.onload = function() {
-            if (path.startsWith('/note/')) {
-                document.getElementById('home-view').classList.add('hidden');
-                document.getElementById('note-wrapper').classList.remove('hidden');
-                document.getElementById('create-view').classList.add('hidden');
-                document.getElementById('decrypt-view').classList.remove('hidden');
-                initNoteView();
-            } else if (path.startsWith('/chat/')) {
-                document.getElementById('home-view').classList.add('hidden');
-                document.getElementById('chat-view').classList.remove('hidden');
-                initChat();
-            } else { loadRooms(); }
-        };
-
-        async function createTempRoom() {
-            const key = await window.crypto.subtle.generateKey({ name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
-            const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
-            const resp = await fetch('/api/room/create_temp', { method: 'POST' });
-            const data = await resp.json();
-            if(data.error) return alert(data.error);
-            sessionStorage.setItem('owner_token_' + data.id, data.owner_token);
-            window.location.href = '/chat/' + data.id + '#' + JSON.stringify(exportedKey);
-        }
-
-        let chatKey = null, lastMsgTime = 0, chatRoomId = null, heartbeatInterval = null;
-
-        async function initChat() {
-            chatRoomId = path.split('/').pop();
-            const ownerToken = sessionStorage.getItem('owner_token_' + chatRoomId);
-            if (ownerToken) {
-                document.getElementById('copy-link-btn').style.display = 'block'; 
-                heartbeatInterval = setInterval(() => {
-                    fetch('/api/room/heartbeat', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: chatRoomId, owner_token: ownerToken }) });
-                }, 3000);
-            }
-            if (!window.location.hash) {
-                const pass = prompt("请输入密码:");
-                if(pass) {
-                    const resp = await fetch('/api/room/info/' + chatRoomId);
-                    const data = await resp.json();
-                    if(data.error) { alert('房间已销毁'); window.location.href='/'; return; }
-                    chatKey = await getKey(pass, base64ToArrayBuffer(data.salt));
-                } else { return appendChatMsg("缺少密钥", "system-msg"); }
-            } else {
-                try {
-                    const jwk = JSON.parse(decodeURIComponent(window.location.hash.substring(1)));
-                    chatKey = await window.crypto.subtle.importKey("jwk", jwk, { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
-                } catch(e) { return appendChatMsg("密钥错误", "system-msg"); }
-            }
-            appendChatMsg("已连接。消息5分钟销毁。", "system-msg");
-            if(ownerToken) appendChatMsg("【房主】页面关闭后房间将销毁。", "system-msg");
-            setInterval(pollMessages, 1500);
-        }
-
-        async function pollMessages() {
-            if (!chatRoomId || !chatKey) return;
-            try {
-                const resp = await fetch(`/api/chat/poll/${chatRoomId}?last=${lastMsgTime}`);
-                const data = await resp.json();
-                if (data.status === 'room_gone') { alert('房间已销毁'); window.location.href = '/'; return; }
-                for (const msg of data) {
-                    if (msg.created_at > lastMsgTime) lastMsgTime = msg.created_at;
-                    if (msg.sender_id === myClientId) continue; 
-                    try { const text = await decryptData(msg.ciphertext, msg.iv, chatKey); appendChatMsg(text, 'other'); } catch (e) { }
-                }
-            } catch(e) {}
-        }
-
-        async function exitChat() {
-            if(confirm("确定退出吗？")) {
-                const ownerToken = sessionStorage.getItem('owner_token_' + chatRoomId);
-                if(ownerToken) {
-                    await fetch('/api/room/delete', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: chatRoomId, owner_token: ownerToken }) });
-                }
-                window.location.href = '/';
-            }
-        }
-
-        function copyRoomLink() {
-            navigator.clipboard.writeText(window.location.href).then(() => alert('邀请链接已复制'));
-        }
-
-        function copyNoteLink() {
-            const link = document.getElementById('share-link').innerText;
-            navigator.clipboard.writeText(link).then(() => alert('私密链接已复制，请发送给对方。'));
-        }
-
-        async function sendChatMsg() {
-            const input = document.getElementById('chat-msg-input');
-            const text = input.value.trim();
-            if (!text || !chatKey) return;
-            input.value = ''; appendChatMsg(text, 'me');
-            try {
-                const result = await encryptData(text, chatKey);
-                await fetch('/api/chat/send', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: chatRoomId, ciphertext: result.ciphertext, iv: result.iv, sender_id: myClientId }) });
-            } catch(e) {
-                if(e.message && e.message.includes('413')) alert('内容太长');
-                else if(e.message && e.message.includes('429')) alert('说话太快了，请慢一点');
-            }
-        }
-
-        function appendChatMsg(text, type) {
-            const box = document.getElementById('chat-box');
-            if (type === 'system-msg') {
-                const div = document.createElement('div'); div.className = 'system-msg'; div.innerText = text; box.appendChild(div);
-            } else {
-                const row = document.createElement('div'); row.className = 'msg-row ' + type;
-                const bubble = document.createElement('div'); bubble.className = 'msg-bubble';
-                
-                let safeText = text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
-                const urlRegex = /(https?:\/\/[^"'\s]+)/g;
-                
-                const imgRegex = /(https?:\/\/[^"'\s]+\.(?:png|jpg|jpeg|gif|webp))/i;
-                const videoRegex = /(https?:\/\/[^"'\s]+\.(?:mp4|webm|ogg))/i;
-
-                if (imgRegex.test(text)) {
-                    bubble.innerHTML = safeText.replace(urlRegex, '<div class="media-placeholder" onclick="window.loadMedia(this, \'$1\', \'img\')">🖼️ 点击加载图片 (隐私保护)</div>');
-                } else if (videoRegex.test(text)) {
-                    bubble.innerHTML = safeText.replace(urlRegex, '<div class="media-placeholder" onclick="window.loadMedia(this, \'$1\', \'video\')">▶️ 点击播放视频 (隐私保护)</div>');
-                } else {
-                    bubble.innerHTML = safeText.replace(urlRegex, '<a href="$1" target="_blank" rel="noopener noreferrer">$1</a>');
-                }
-                
-                row.appendChild(bubble); box.appendChild(row);
-            }
-            box.scrollTop = box.scrollHeight;
-        }
-
-        async function loadRooms() {
-            try {
-                const resp = await fetch('/api/rooms');
-                const rooms = await resp.json();
-                const listEl = document.getElementById('room-list');
-                listEl.innerHTML = '';
-                if (rooms.length === 0) { listEl.innerHTML = '<div style="text-align:center; color:#64748b; padding:20px;">暂无公开房间</div>'; return; }
-                rooms.forEach(room => {
-                    const div = document.createElement('div'); div.className = 'room-item';
-                    div.innerHTML = `<div class="room-info"><span class="room-name">${escapeHtml(room.name)}</span><span class="room-time">${new Date(room.created_at * 1000).toLocaleString()}</span></div><div style="display:flex; gap:5px;"><button class="btn btn-primary btn-sm" onclick="joinRoom('${room.id}', '${room.name}', '${room.salt}')">加入</button><button class="btn btn-danger btn-sm" style="padding:8px 10px;" onclick="deleteRoom('${room.id}')">×</button></div>`;
-                    listEl.appendChild(div);
-                });
-            } catch (e) {}
-        }
-        async function createPublicRoom() {
-            const name = document.getElementById('new-room-name').value.trim();
-            const pass = document.getElementById('new-room-pass').value;
-            const adminCode = document.getElementById('admin-code').value;
-            if (!name || !pass || !adminCode) return alert('请填写完整');
-            const salt = window.crypto.getRandomValues(new Uint8Array(16));
-            const saltBase64 = arrayBufferToBase64(salt);
-            const key = await getKey(pass, salt);
-            const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
-            const resp = await fetch('/api/room/create_public', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ name: name, salt: saltBase64, admin_code: adminCode }) });
-            const data = await resp.json();
-            if (data.error) return alert(data.error);
-            window.location.href = '/chat/' + data.id + '#' + JSON.stringify(exportedKey);
-        }
-        async function joinRoom(id, name, saltBase64) {
-            const pass = prompt(`请输入房间 "${name}" 的密码:`);
-            if (!pass) return;
-            try {
-                const salt = base64ToArrayBuffer(saltBase64);
-                const key = await getKey(pass, salt);
-                const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
-                window.location.href = '/chat/' + id + '#' + JSON.stringify(exportedKey);
-            } catch (e) { alert('错误'); }
-        }
-        async function deleteRoom(id) {
-            const code = prompt("管理员口令:");
-            if(!code) return;
-            const resp = await fetch('/api/room/delete', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: id, admin_code: code }) });
-            const data = await resp.json();
-            if(data.error) alert(data.error); else loadRooms();
-        }
-
-        function showCreateRoomModal() { document.getElementById('create-room-modal').classList.remove('hidden'); }
-        function closeModal(id) { document.getElementById(id).classList.add('hidden'); }
-        function showNoteCreate() { document.getElementById('home-view').classList.add('hidden'); document.getElementById('note-wrapper').classList.remove('hidden'); }
-        function escapeHtml(text) { const div = document.createElement('div'); div.innerText = text; return div.innerHTML; }
-        
-        function initNoteView() {
-            const isBurn = document.body.getAttribute('data-burn') === '1';
-            const title = document.getElementById('view-title');
-            if (isBurn) { title.innerText = "🔥 阅后即焚"; document.getElementById('view-desc').innerText = "⚠️ 注意：此笔记阅读一次后将立即销毁！"; }
-            else { title.innerText = "📅 限时笔记"; document.getElementById('view-desc').innerText = "此笔记在过期前可多次查看。"; }
-            if (document.body.getAttribute('data-pass') === 'true') document.getElementById('pass-input-area').classList.remove('hidden');
-        }
-        async function createNote() {
-            const text = document.getElementById('content').value;
-            if (!text) return;
-            const btn = document.getElementById('create-btn'); btn.innerText = '处理中...'; btn.disabled = true;
-            try {
-                const password = document.getElementById('password').value;
-                let key, salt;
-                if (password) { salt = window.crypto.getRandomValues(new Uint8Array(16)); key = await getKey(password, salt); }
-                else { key = await window.crypto.subtle.generateKey({ name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]); salt = null; }
-                const result = await encryptData(text, key);
-                const exportKey = password ? null : await window.crypto.subtle.exportKey("jwk", key);
-                const isBurn = document.getElementById('burn-toggle').checked;
-                const resp = await fetch('/api/note/create', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ ciphertext: result.ciphertext, iv: result.iv, salt: salt ? arrayBufferToBase64(salt) : null, expire_hours: document.getElementById('expiration').value, burn_mode: isBurn ? 1 : 0 }) });
-                const data = await resp.json();
-                let link = window.location.origin + '/note/' + data.id;
-                if (!password) link += '#' + JSON.stringify(exportKey);
-                else document.getElementById('password-reminder').classList.remove('hidden');
-                document.getElementById('create-view').classList.add('hidden');
-                document.getElementById('result-view').classList.remove('hidden');
-                document.getElementById('share-link').innerText = link;
-            } catch(e) { alert('错误: ' + e); btn.disabled = false; }
-        }
-        async function fetchAndDecryptNote() {
-            const id = path.split('/').pop();
-            try {
-                const resp = await fetch('/api/note/read/' + id, { method: 'POST' });
-                const data = await resp.json();
-                if (data.error) return alert(data.error);
-                let key;
-                if (data.salt) {
-                    const pwd = document.getElementById('decrypt-pass').value;
-                    if (!pwd) return alert('请输入密码');
-                    key = await getKey(pwd, base64ToArrayBuffer(data.salt));
-                } else { key = await window.crypto.subtle.importKey("jwk", JSON.parse(decodeURIComponent(window.location.hash.substring(1))), { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]); }
-                const text = await decryptData(data.ciphertext, data.iv, key);
-                document.getElementById('decrypt-view').classList.add('hidden');
-                document.getElementById('content-view').classList.remove('hidden');
-                document.getElementById('decrypted-content').value = text;
-                const status = document.getElementById('burn-status');
-                if (document.body.getAttribute('data-burn') === '1') status.innerText = "🔥 笔记已销毁，无法再次访问。";
-                else { status.innerText = "✅ 笔记暂未销毁，过期前可再次访问。"; status.style.color = "#10b981"; }
-            } catch(e) { alert('解密失败，密码错误或链接无效'); }
-        }
-    </script>
-</body>
-</html>
-"""
-
-HTML_LAYOUT = HTML_LAYOUT.replace('__FILE_URL__', FILE_URL)
 
-@app.route('/')
-def index(): return HTML_LAYOUT
+@app.teardown_request
+def release_db(exc):
+    for db in DATABASES.values(): db.release()
 
-@app.route('/note/<id>')
-def note_page(id):
-    conn = get_db()
-    row = conn.execute('SELECT salt, expire_at, burn_mode FROM secrets WHERE id = ?', (id,)).fetchone()
-    conn.close()
-    if not row or datetime.datetime.strptime(row['expire_at'], '%Y-%m-%d %H:%M:%S.%f') < datetime.datetime.now():
-        return HTML_LAYOUT.replace('<body>', '<body onload="alert(\'笔记不存在或已过期\');location.href=\'/\'">')
-    has_pass = 'true' if row['salt'] else 'false'
-    is_burn = '1' if row['burn_mode'] is None or row['burn_mode'] == 1 else '0'
-    return HTML_LAYOUT.replace('<body>', f'<body data-pass="{has_pass}" data-burn="{is_burn}">')
+class GroupCommitWriter:
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.stats = {'batches': 0, 'jobs': 0}
+
+    def submit(self, job, committed=None):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.queue = os.getpid(), queue.Queue()
+                threading.Thread(target=self.run, args=(self.queue,), name='writer-' + self.db.name, daemon=True).start()
+        future = Future()
+        self.queue.put((job, future, committed))
+        return future
+
+    def write(self, job):
+        return self.submit(job).result()
+
+    def pending(self):
+        return self.queue.qsize() if self.pid == os.getpid() else 0
+
+    def collect(self, jobs):
+        batch = [jobs.get()]
+        deadline = time.monotonic() + GROUP_COMMIT_MS / 1000
+        while len(batch) < GROUP_COMMIT_MAX:
+            try: batch.append(jobs.get_nowait())
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: batch.append(jobs.get(timeout=remaining))
+                except queue.Empty: break
+        return batch
+
+    def run(self, jobs):
+        conn = self.db.connect()
+        conn.isolation_level = None
+        conn.execute('PRAGMA synchronous = FULL;')
+        labels = (('db', self.db.name),)
+        while True:
+            batch = self.collect(jobs)
+            results = []
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for job, future, committed in batch:
+                    conn.execute('SAVEPOINT job')
+                    try: results.append((future, job(conn), None, committed))
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO job')
+                        results.append((future, None, e, None))
+                    conn.execute('RELEASE job')
+                conn.execute('COMMIT')
+            except Exception as e:
+                if conn.in_transaction: conn.execute('ROLLBACK')
+                results = [(future, None, e, None) for _, future, _ in batch]
+            self.stats['batches'] += 1
+            self.stats['jobs'] += len(batch)
+            METRICS.inc('writer_batches_total', labels)
+            METRICS.inc('writer_jobs_total', labels, len(batch))
+            for future, result, error, committed in results:
+                if committed:
+                    try: committed(result)
+                    except Exception as e: app.logger.warning('writer %s: %s', self.db.name, e)
+                if error is None: future.set_result(result)
+                else: future.set_exception(error)
+
+NOTES_DB = Database('notes', DB_NAME, 'notes', MIGRATIONS)
+ROOMS_DB = Database('rooms', db_path('rooms'), 'chat', CHAT_MIGRATIONS)
+EPHEMERAL_DB = None if EPHEMERAL_IN_MEMORY else Database('ephemeral', db_path('ephemeral'), 'chat', CHAT_MIGRATIONS)
+CHAT_DBS = [Database(f'chat-{i}', db_path(f'chat-{i}'), 'chat', CHAT_MIGRATIONS) for i in range(CHAT_SHARDS)] if CHAT_SHARDS > 1 else []
+DATABASES = {db.name: db for db in (ROOMS_DB, EPHEMERAL_DB, *CHAT_DBS, NOTES_DB) if db}
+MESSAGE_DBS = {db.name: db for db in CHAT_DBS or (ROOMS_DB, EPHEMERAL_DB) if db}
+for db in DATABASES.values(): init_db(db)
+os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+
+def write_backlog():
+    return max(db.writer.pending() for db in DATABASES.values())
+
+def message_entries(ids, rows):
+    return [{'id': msg_id, 'room_id': room_id, 'ciphertext': ciphertext, 'iv': iv, 'created_at': created_at, 'sender_id': sender_id} for msg_id, (room_id, ciphertext, iv, created_at, sender_id) in zip(ids, rows)]
+
+class SQLiteStorage:
+    def __init__(self, notes, rooms, shards):
+        self.notes = notes
+        self.rooms = rooms
+        self.shards = shards
+
+    def shard(self, room_id):
+        return self.shards[zlib.crc32(room_id.encode()) % len(self.shards)]
+
+    def by_shard(self, room_ids):
+        groups = {}
+        for room_id in room_ids: groups.setdefault(self.shard(room_id), []).append(room_id)
+        return groups
+
+    def create_note(self, uid, ciphertext, iv, salt, expire_at, burn_mode):
+        self.notes.writer.write(lambda conn: conn.execute('INSERT INTO secrets (id, ciphertext, iv, salt, expire_at, burn_mode) VALUES (?,?,?,?,?,?)', (uid, ciphertext, iv, salt, expire_at, burn_mode)))
+
+    def note_meta(self, uid, now):
+        row = self.notes.conn().execute('SELECT length(salt) > 0 AS has_pass, burn_mode IS NOT 0 AS burn FROM secrets WHERE id = ? AND expire_at > ?', (uid, now)).fetchone()
+        return row and {'has_pass': bool(row['has_pass']), 'burn': bool(row['burn'])}
+
+    def take_note(self, uid, now):
+        return (self.notes.writer.write(lambda conn: conn.execute('DELETE FROM secrets WHERE id = ? AND burn_mode IS NOT 0 AND expire_at > ? RETURNING ciphertext, iv, salt', (uid, now)).fetchall()) or [None])[0]
+
+    def peek_note(self, uid, now):
+        return self.notes.conn().execute('SELECT ciphertext, iv, salt FROM secrets WHERE id = ? AND burn_mode = 0 AND expire_at > ?', (uid, now)).fetchone()
+
+    def create_attachment(self, uid, room_id, size, expire_at, burn_mode):
+        self.notes.writer.write(lambda conn: conn.execute('INSERT INTO attachments (id, room_id, size, expire_at, burn_mode) VALUES (?,?,?,?,?)', (uid, room_id, size, expire_at, burn_mode)))
+
+    def take_attachment(self, uid, now):
+        rows = self.notes.writer.write(lambda conn: conn.execute('DELETE FROM attachments WHERE id = ? AND burn_mode IS NOT 0 AND expire_at > ? RETURNING size', (uid, now)).fetchall())
+        return rows[0]['size'] if rows else None
+
+    def peek_attachment(self, uid, now):
+        row = self.notes.conn().execute('SELECT size FROM attachments WHERE id = ? AND burn_mode = 0 AND expire_at > ?', (uid, now)).fetchone()
+        return row['size'] if row else None
+
+    def drop_room_attachments(self, room_id):
+        conn = self.notes.conn()
+        ids = [row[0] for row in conn.execute('DELETE FROM attachments WHERE room_id = ? RETURNING id', (room_id,)).fetchall()]
+        conn.commit()
+        return ids
+
+    def create_room(self, room):
+        conn = self.rooms.conn()
+        conn.execute('INSERT INTO rooms (id, name, is_public, salt, created_at, owner_token, last_active) VALUES (:id, :name, :is_public, :salt, :created_at, :owner_token, :last_active)', room)
+        conn.commit()
+
+    def is_owner(self, room_id, token):
+        return self.rooms.conn().execute('SELECT 1 FROM rooms WHERE id = ? AND owner_token = ?', (room_id, token)).fetchone() is not None
+
+    def room_salt(self, room_id):
+        row = self.rooms.conn().execute('SELECT salt FROM rooms WHERE id = ?', (room_id,)).fetchone()
+        return row['salt'] if row else None
+
+    def room_states(self, room_ids):
+        return self.rooms.conn().execute(f'SELECT id, is_public, last_active FROM rooms WHERE id IN ({",".join("?" * len(room_ids))})', room_ids).fetchall()
+
+    def delete_room(self, room_id):
+        conn, shard = self.rooms.conn(), self.shard(room_id).conn()
+        conn.execute('DELETE FROM rooms WHERE id = ?', (room_id,))
+        shard.execute('DELETE FROM chat_messages WHERE room_id = ?', (room_id,))
+        conn.commit()
+        shard.commit()
+
+    def public_rooms(self, since):
+        return [dict(row) for row in self.rooms.conn().execute('SELECT id, name, created_at, salt FROM rooms WHERE is_public = 1 AND created_at > ? ORDER BY created_at DESC', (since,))]
+
+    def touch_rooms(self, beats):
+        conn = self.rooms.conn()
+        conn.executemany('UPDATE rooms SET last_active = MAX(last_active, ?) WHERE id = ?', [(beat, room_id) for room_id, beat in beats])
+        conn.commit()
+
+    def add_messages(self, rows, deliver=None):
+        groups = {}
+        for i, row in enumerate(rows): groups.setdefault(self.shard(row[0]), []).append(i)
+        futures = []
+        for db, group in groups.items():
+            batch = [rows[i] for i in group]
+            committed = deliver and (lambda ids, db=db, batch=batch: deliver(db.name, message_entries(ids, batch)))
+            futures.append((db.writer.submit(lambda conn, batch=batch: [conn.execute('INSERT INTO chat_messages (room_id, ciphertext, iv, created_at, sender_id) VALUES (?,?,?,?,?)', row).lastrowid for row in batch], committed), group))
+        ids = [None] * len(rows)
+        for future, group in futures:
+            for i, msg_id in zip(group, future.result()): ids[i] = msg_id
+        return ids
+
+    def recent_messages(self, room_ids, since):
+        return [row for db, group in self.by_shard(room_ids).items() for row in db.conn().execute(f'SELECT id, room_id, ciphertext, iv, created_at, sender_id FROM chat_messages WHERE room_id IN ({",".join("?" * len(group))}) AND created_at > ?', [*group, since]).fetchall()]
+
+class IdCounter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.value = int(time.time() * 1000) << 10
+        self.pid = None
+        self.fd = None
+
+    def take(self, count):
+        with self.lock:
+            if not self.path:
+                self.value += count
+                return self.value
+            if self.pid != os.getpid():
+                os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+                self.fd, self.pid = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), os.getpid()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self.fd, 8, 0)
+                value = (struct.unpack('>Q', data)[0] if len(data) == 8 else self.value) + count
+                os.pwrite(self.fd, struct.pack('>Q', value), 0)
+                return value
+            finally: fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+class MemoryStorage:
+    def __init__(self, ids=None):
+        self.lock = threading.Lock()
+        self.notes = {}
+        self.rooms = {}
+        self.messages = {}
+        self.ids = ids or IdCounter(None)
+
+    def create_note(self, uid, ciphertext, iv, salt, expire_at, burn_mode):
+        self.notes[uid] = {'ciphertext': ciphertext, 'iv': iv, 'salt': salt, 'expire_at': expire_at, 'burn_mode': burn_mode}
+
+    def note_meta(self, uid, now):
+        note = self.notes.get(uid)
+        if note and note['expire_at'] > now: return {'has_pass': bool(note['salt']), 'burn': note['burn_mode'] != 0}
+
+    def take_note(self, uid, now):
+        with self.lock:
+            note = self.notes.get(uid)
+            if note and note['burn_mode'] != 0 and note['expire_at'] > now: return self.notes.pop(uid)
+
+    def peek_note(self, uid, now):
+        note = self.notes.get(uid)
+        if note and note['burn_mode'] == 0 and note['expire_at'] > now: return note
+
+    def create_room(self, room):
+        self.rooms[room['id']] = dict(room)
+
+    def is_owner(self, room_id, token):
+        room = self.rooms.get(room_id)
+        return bool(room and token and room['owner_token'] == token)
+
+    def room_salt(self, room_id):
+        room = self.rooms.get(room_id)
+        return room['salt'] if room else None
+
+    def room_states(self, room_ids):
+        return [self.rooms[room_id] for room_id in room_ids if room_id in self.rooms]
+
+    def delete_room(self, room_id):
+        with self.lock:
+            self.rooms.pop(room_id, None)
+            self.messages.pop(room_id, None)
+
+    def public_rooms(self, since):
+        rooms = [{key: room[key] for key in ('id', 'name', 'created_at', 'salt')} for room in list(self.rooms.values()) if room['is_public'] == 1 and room['created_at'] > since]
+        return sorted(rooms, key=lambda room: room['created_at'], reverse=True)
+
+    def touch_rooms(self, beats):
+        for room_id, beat in beats:
+            room = self.rooms.get(room_id)
+            if room: room['last_active'] = max(room['last_active'], beat)
+
+    def add_messages(self, rows, deliver=None):
+        with self.lock:
+            last = self.ids.take(len(rows))
+            entries = message_entries(range(last - len(rows) + 1, last + 1), rows)
+            for entry in entries: self.messages.setdefault(entry['room_id'], []).append(entry)
+            if deliver: deliver('memory', entries)
+        return [entry['id'] for entry in entries]
+
+    def put_message(self, entry):
+        with self.lock:
+            msgs = self.messages.setdefault(entry['room_id'], [])
+            if all(msg['id'] != entry['id'] for msg in msgs): msgs.append(entry)
+
+    def temp_rooms(self):
+        with self.lock: return [(dict(room), list(self.messages.get(room_id, ()))) for room_id, room in self.rooms.items() if room['is_public'] == 0]
+
+    def recent_messages(self, room_ids, since):
+        with self.lock: return [msg for room_id in room_ids for msg in self.messages.get(room_id, ()) if msg['created_at'] > since]
+
+    def message_count(self, since):
+        with self.lock: return sum(1 for msgs in self.messages.values() for msg in msgs if msg['created_at'] > since)
+
+    def expire(self, now):
+        with self.lock:
+            for uid in [uid for uid, note in self.notes.items() if note['expire_at'] < now]: del self.notes[uid]
+            for room_id, room in list(self.rooms.items()):
+                if room['is_public'] == 0 and max(room['last_active'], PRESENCE.get(room_id, 0)) < now - 600:
+                    del self.rooms[room_id]
+                    self.messages.pop(room_id, None)
+            for room_id, msgs in list(self.messages.items()):
+                msgs = [msg for msg in msgs if msg['created_at'] > now - MESSAGE_TTL]
+                if msgs: self.messages[room_id] = msgs
+                else: del self.messages[room_id]
+
+class InstrumentedStorage:
+    def __init__(self, store, engine):
+        self.store = store
+        self.engine = engine
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+        labels = (('engine', self.engine), ('method', name))
+        def timed(*args):
+            started = time.perf_counter()
+            try: result = method(*args)
+            finally: METRICS.observe('storage_call_duration_seconds', labels, time.perf_counter() - started)
+            if isinstance(result, list): METRICS.inc('storage_rows_total', labels, len(result))
+            return result
+        setattr(self, name, timed)
+        return timed
+
+def make_storage(store, engine):
+    return InstrumentedStorage(store, engine) if METRICS_ENABLED else store
+
+STORE = make_storage(SQLiteStorage(NOTES_DB, ROOMS_DB, CHAT_DBS or [ROOMS_DB]), 'sqlite')
+MESSAGE_IDS = IdCounter(BUS_DIR + '.ids' if BUS_DIR else None)
+EPHEMERAL = make_storage(MemoryStorage(MESSAGE_IDS), 'memory') if EPHEMERAL_IN_MEMORY else make_storage(SQLiteStorage(NOTES_DB, EPHEMERAL_DB, CHAT_DBS or [EPHEMERAL_DB]), 'sqlite')
+
+def room_store(room_id):
+    kind = ROOM_KINDS.get(room_id)
+    if kind is None: kind = 0 if EPHEMERAL.room_states([room_id]) or EPHEMERAL_IN_MEMORY and not STORE.room_states([room_id]) else 1
+    return EPHEMERAL if kind == 0 else STORE
+
+class MemoryRateStore:
+    def __init__(self, max_keys):
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_keys = max_keys
+
+    def take(self, key, capacity, rate, cost, now):
+        with self.lock:
+            tokens, ts = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys: self.buckets.popitem(last=False)
+            return allowed
+
+    def purge(self, now):
+        idle = now - RATE_IDLE
+        with self.lock:
+            while self.buckets and next(iter(self.buckets.values()))[1] < idle: self.buckets.popitem(last=False)
+
+    def size(self):
+        return len(self.buckets)
+
+class SQLiteRateStore:
+    def __init__(self, path, max_keys):
+        self.path = path
+        self.max_keys = max_keys
+        self.local = threading.local()
+
+    def db(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL;')
+            conn.execute('PRAGMA synchronous = OFF;')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, ts REAL) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_buckets_ts ON buckets (ts)')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return self.local.conn
+
+    def take(self, key, capacity, rate, cost, now):
+        res = self.db().execute('''INSERT INTO buckets (key, tokens, ts) VALUES (:key, :cap - :cost, :now)
+            ON CONFLICT(key) DO UPDATE SET tokens = MIN(:cap, tokens + (:now - ts) * :rate) - :cost, ts = :now
+            WHERE MIN(:cap, tokens + (:now - ts) * :rate) >= :cost''', {'key': key, 'cap': capacity, 'rate': rate, 'cost': cost, 'now': now})
+        return res.rowcount == 1
+
+    def purge(self, now):
+        conn = self.db()
+        conn.execute('DELETE FROM buckets WHERE ts < ?', (now - RATE_IDLE,))
+        conn.execute('DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY ts DESC LIMIT -1 OFFSET ?)', (self.max_keys,))
+
+    def size(self):
+        return self.db().execute('SELECT count(*) FROM buckets').fetchone()[0]
+
+class RedisRateStore:
+    SCRIPT = '''
+local b = redis.call('HMGET', KEYS[1], 't', 'ts')
+local cap, rate, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local t = math.min(cap, (tonumber(b[1]) or cap) + (now - (tonumber(b[2]) or now)) * rate)
+local ok = 0
+if t >= cost then t = t - cost; ok = 1 end
+redis.call('HSET', KEYS[1], 't', t, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(cap / rate) + 1)
+return ok'''
+
+    def __init__(self, client):
+        self.take_script = client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, rate, cost, now):
+        return self.take_script(keys=['rl:' + key], args=[capacity, rate, cost, now]) == 1
+
+    def purge(self, now): pass
+
+    def size(self): return None
+
+def make_rate_store():
+    if RATE_LIMIT_BACKEND == 'memory': return MemoryRateStore(RATE_MAX_KEYS)
+    if RATE_LIMIT_BACKEND == 'redis':
+        if redis is None: raise RuntimeError('RATE_LIMIT_BACKEND=redis requires the redis package')
+        return RedisRateStore(redis.Redis.from_url(REDIS_URL))
+    return SQLiteRateStore(RATE_DB_NAME, RATE_MAX_KEYS)
+
+RATE_IDLE = max(capacity / rate for capacity, rate in RATE_POLICIES.values())
+RATE_STORE = make_rate_store()
+
+def client_ip():
+    return request.headers.get('X-Forwarded-For', request.remote_addr)
+
+def rate_limited(policy, cost=1, ip=None):
+    capacity, rate = RATE_POLICIES[policy]
+    limited = not RATE_STORE.take(f'{policy}:{ip or client_ip()}', capacity, rate, cost, time.time())
+    if limited: METRICS.inc('rate_limited_total', (('policy', policy),))
+    return limited
+
+def acquire_room_signal(room_id):
+    with ROOM_SIGNALS_LOCK:
+        sig = ROOM_SIGNALS.get(room_id)
+        if sig is None: sig = ROOM_SIGNALS[room_id] = {'cond': threading.Condition(), 'waiters': 0, 'seq': 0}
+        sig['waiters'] += 1
+        return sig
+
+def release_room_signal(room_id, sig):
+    with ROOM_SIGNALS_LOCK:
+        sig['waiters'] -= 1
+        if sig['waiters'] == 0 and ROOM_SIGNALS.get(room_id) is sig: del ROOM_SIGNALS[room_id]
+
+def notify_room(room_id):
+    sig = ROOM_SIGNALS.get(room_id)
+    if sig:
+        with sig['cond']:
+            sig['seq'] += 1
+            sig['cond'].notify_all()
+    for listener in ROOM_LISTENERS: listener(room_id)
+
+class RoomBuffer:
+    def __init__(self, primed):
+        self.entries = []
+        self.ids = []
+        self.bytes = 0
+        self.primed = primed
+        self.floor = 0
+        self.time_floor = time.time() - MESSAGE_TTL
+
+    def add(self, entry):
+        if entry['id'] <= self.floor or entry['created_at'] <= self.time_floor: return 0
+        pos = bisect.bisect_left(self.ids, entry['id'])
+        if pos < len(self.ids) and self.ids[pos] == entry['id']: return 0
+        self.ids.insert(pos, entry['id'])
+        self.entries.insert(pos, entry)
+        size = len(entry['ciphertext']) + len(entry['iv'])
+        self.bytes += size
+        return size
+
+    def pop_oldest(self, evicted=True):
+        entry = self.entries.pop(0)
+        self.ids.pop(0)
+        if evicted: self.floor, self.time_floor = max(self.floor, entry['id']), max(self.time_floor, entry['created_at'])
+        size = len(entry['ciphertext']) + len(entry['iv'])
+        self.bytes -= size
+        return size
+
+class MessageCache:
+    def __init__(self):
+        self.rooms = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'primes': 0, 'evicted_messages': 0, 'evicted_rooms': 0, 'invalidations': 0}
+
+    def add(self, room_id, entry, primed=False):
+        with self.lock:
+            buf = self.rooms.get(room_id)
+            if buf is None: buf = self.rooms[room_id] = RoomBuffer(primed)
+            self.bytes += buf.add(entry)
+            self.trim(buf)
+
+    def trim(self, buf):
+        while len(buf.entries) > CACHE_ROOM_MAX_MESSAGES or buf.bytes > CACHE_ROOM_MAX_BYTES:
+            self.bytes -= buf.pop_oldest()
+            self.stats['evicted_messages'] += 1
+        while self.bytes > CACHE_MAX_BYTES and len(self.rooms) > 1:
+            _, old = self.rooms.popitem(last=False)
+            self.bytes -= old.bytes
+            self.stats['evicted_rooms'] += 1
+
+    def read(self, room_id, after=0, since=0.0):
+        with self.lock:
+            buf = self.rooms.get(room_id)
+            cutoff = max(since, time.time() - MESSAGE_TTL)
+            if buf is None or not buf.primed or (after < buf.floor if after else cutoff < buf.time_floor):
+                self.stats['misses'] += 1
+                return None
+            self.rooms.move_to_end(room_id)
+            while buf.entries and buf.entries[0]['created_at'] <= time.time() - MESSAGE_TTL: self.bytes -= buf.pop_oldest(evicted=False)
+            self.stats['hits'] += 1
+            entries = buf.entries[bisect.bisect_right(buf.ids, after):]
+            return [entry for entry in entries if entry['created_at'] > cutoff] if since else entries
+
+    def prime(self, room_id, rows, since):
+        with self.lock:
+            buf = self.rooms.get(room_id)
+            if buf is None: buf = self.rooms[room_id] = RoomBuffer(False)
+            self.rooms.move_to_end(room_id)
+            buf.floor, buf.time_floor = 0, min(buf.time_floor, since)
+            for row in rows: self.bytes += buf.add({'id': row['id'], 'room_id': room_id, 'created_at': row['created_at'], 'sender_id': row['sender_id'], 'iv': row['iv'], 'ciphertext': row['ciphertext']})
+            buf.primed = True
+            self.trim(buf)
+            self.stats['primes'] += 1
+
+    def drop(self, room_id):
+        with self.lock:
+            buf = self.rooms.pop(room_id, None)
+            if buf: self.bytes -= buf.bytes
+
+    def invalidate(self):
+        with self.lock:
+            for buf in self.rooms.values(): buf.primed = False
+            self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self.lock: return dict(self.stats, rooms=len(self.rooms), bytes=self.bytes, messages=sum(len(buf.entries) for buf in self.rooms.values()))
+
+    def last_activity(self, room_id):
+        buf = self.rooms.get(room_id)
+        entries = buf.entries if buf else None
+        return entries[-1]['created_at'] if entries else 0
+
+class MessageSequencer:
+    def __init__(self, dbs):
+        self.dbs = dbs
+        self.lock = threading.Lock()
+        self.marks = {}
+        self.held = {}
+        self.stalled = {}
+
+    def reset(self, marks):
+        with self.lock: self.marks, self.held, self.stalled = dict(marks), {}, {}
+
+    def missed(self, source, low, high):
+        rows = self.dbs[source].conn().execute('SELECT id, room_id, ciphertext, iv, created_at, sender_id FROM chat_messages WHERE id > ? AND id < ? AND created_at > ?', (low, high, time.time() - MESSAGE_TTL)).fetchall()
+        return [dict(row) for row in rows]
+
+    def release(self, source):
+        mark, held, ready = self.marks[source], self.held.get(source, {}), []
+        while held:
+            low = min(held)
+            if low > mark + 1:
+                if source in self.dbs: ready += self.missed(source, mark, low)
+                elif time.monotonic() - self.stalled.setdefault(source, time.monotonic()) < SEQUENCE_HOLD: break
+            self.stalled.pop(source, None)
+            mark = low
+            ready.append(held.pop(low))
+        self.marks[source] = mark
+        return ready
+
+    def deliver(self, source, entries):
+        with self.lock:
+            if source not in self.marks: self.marks[source] = min(entry['id'] for entry in entries) - 1
+            ready = [entry for entry in entries if entry['id'] <= self.marks[source]]
+            self.held.setdefault(source, {}).update((entry['id'], entry) for entry in entries if entry['id'] > self.marks[source])
+            ready += self.release(source)
+            for entry in ready: CACHE.add(entry['room_id'], entry, primed=source == 'memory')
+        for room_id in {entry['room_id'] for entry in ready}: notify_room(room_id)
+
+    def expire(self):
+        with self.lock:
+            ready = [(source, entry) for source in list(self.held) for entry in self.release(source)]
+            for source, entry in ready: CACHE.add(entry['room_id'], entry, primed=source == 'memory')
+        for room_id in {entry['room_id'] for _, entry in ready}: notify_room(room_id)
+
+    def settled(self, source, rows):
+        mark = self.marks.get(source)
+        return rows if mark is None else [row for row in rows if row['id'] <= mark]
+
+class MessageBus:
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.name = None
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.peers = {}
+        self.handlers = {}
+        self.on_gap = None
+        self.on_tick = None
+
+    def start(self):
+        if not self.path: return
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        name = os.path.join(self.path, f'{os.getpid()}.sock')
+        if os.path.exists(name): os.unlink(name)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(name)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock, self.name = sock, name
+        threading.Thread(target=self.listen, name='bus', daemon=True).start()
+
+    def publish(self, kind, *parts):
+        if self.sock is None: return 0
+        sent = 0
+        with self.lock:
+            self.seq += 1
+            packet = kind + struct.pack('>IQ', os.getpid(), self.seq) + pack_frame(*parts)
+            for peer in os.listdir(self.path):
+                target = os.path.join(self.path, peer)
+                if target == self.name: continue
+                try:
+                    self.sock.sendto(packet, target)
+                    sent += 1
+                except (ConnectionRefusedError, FileNotFoundError):
+                    try: os.unlink(target)
+                    except OSError: pass
+                except OSError: pass
+        return sent
 
+    def send(self, target, kind, *parts):
+        try: self.sock.sendto(kind + struct.pack('>IQ', os.getpid(), 0) + pack_frame(*parts), target)
+        except OSError: pass
+
+    def listen(self):
+        self.sock.settimeout(SEQUENCE_HOLD)
+        while True:
+            try: packet = self.sock.recv(1024 * 1024)
+            except socket.timeout: packet = None
+            if self.on_tick: self.on_tick()
+            if packet is None: continue
+            try:
+                pid, seq = struct.unpack_from('>IQ', packet, 1)
+                if seq:
+                    if seq != self.peers.get(pid, seq - 1) + 1 and self.on_gap: self.on_gap()
+                    self.peers[pid] = seq
+                handler = self.handlers.get(packet[:1])
+                if handler: handler(packet[13:])
+            except Exception as e: app.logger.warning('bus: %s', e)
+
+def on_bus_message(payload):
+    msg_id, room_id, created_at, sender_id, iv, ciphertext, source = unpack_frame(payload, 7)
+    source = source.decode()
+    entry = {'id': struct.unpack('>Q', msg_id)[0], 'room_id': room_id.decode(), 'created_at': struct.unpack('>d', created_at)[0], 'sender_id': sender_id.decode(), 'iv': iv, 'ciphertext': ciphertext}
+    if source == 'memory' and EPHEMERAL_IN_MEMORY: EPHEMERAL.put_message(entry)
+    SEQUENCER.deliver(source, [entry])
+
+def on_bus_room_gone(payload):
+    room_id = unpack_frame(payload, 1)[0].decode()
+    if EPHEMERAL_IN_MEMORY: EPHEMERAL.delete_room(room_id)
+    forget_room(room_id)
+    notify_room(room_id)
+
+def on_bus_temp_room(payload):
+    room_id, owner_token, created_at = unpack_frame(payload, 3)
+    room_id, created_at = room_id.decode(), struct.unpack('>d', created_at)[0]
+    if not EPHEMERAL.room_states([room_id]): EPHEMERAL.create_room({'id': room_id, 'name': '临时房间', 'is_public': 0, 'salt': '', 'created_at': created_at, 'owner_token': owner_token.decode(), 'last_active': created_at})
+
+def on_bus_sync(payload):
+    if not EPHEMERAL_IN_MEMORY: return
+    target = unpack_frame(payload, 1)[0].decode()
+    for room, msgs in EPHEMERAL.temp_rooms():
+        room_id = room['id'].encode()
+        BUS.send(target, b'T', room_id, room['owner_token'].encode(), struct.pack('>d', room['created_at']))
+        BUS.send(target, b'B', room_id, struct.pack('>d', max(room['last_active'], PRESENCE.get(room['id'], 0))))
+        for entry in msgs: BUS.send(target, b'M', struct.pack('>Q', entry['id']), room_id, struct.pack('>d', entry['created_at']), entry['sender_id'].encode(), entry['iv'], entry['ciphertext'], b'memory')
+    BUS.send(target, b'Z')
+
+def on_bus_synced(payload):
+    SYNC_REPLIES.release()
+
+def sync_temp_rooms():
+    deadline = time.monotonic() + SYNC_TIMEOUT
+    for _ in range(BUS.publish(b'S', BUS.name.encode())):
+        if not SYNC_REPLIES.acquire(timeout=max(deadline - time.monotonic(), 0)): break
+
+def on_bus_beat(payload):
+    room_id, beat = unpack_frame(payload, 2)
+    room_id = room_id.decode()
+    PRESENCE[room_id] = max(PRESENCE.get(room_id, 0), struct.unpack('>d', beat)[0])
+
+def on_bus_rooms_changed(payload):
+    ROOM_DIRECTORY.invalidate()
+
+def on_bus_profile(payload):
+    PROFILER.start(*struct.unpack('>dd', unpack_frame(payload, 1)[0]))
+
+def on_bus_gap():
+    CACHE.invalidate()
+    PRESENCE.clear()
+    ROOM_DIRECTORY.invalidate()
+
+class RoomDirectory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.built = -1
+        self.rooms = []
+
+    def invalidate(self):
+        with self.lock: self.version += 1
+
+    def snapshot(self):
+        with self.lock:
+            if self.built == self.version: return self.rooms
+            version = self.version
+        rooms = STORE.public_rooms(time.time() - 86400)
+        with self.lock:
+            if version == self.version: self.rooms, self.built = rooms, version
+            return rooms
+
+CACHE = MessageCache()
+SEQUENCER = MessageSequencer(MESSAGE_DBS)
+ROOM_DIRECTORY = RoomDirectory()
+ROOM_KINDS = {}
+OWNER_TOKENS = {}
+PRESENCE = {}
+PRESENCE_DIRTY = {}
+BUS = MessageBus(BUS_DIR)
+SYNC_REPLIES = threading.Semaphore(0)
+BUS.handlers = {b'M': on_bus_message, b'G': on_bus_room_gone, b'B': on_bus_beat, b'R': on_bus_rooms_changed, b'T': on_bus_temp_room, b'P': on_bus_profile, b'S': on_bus_sync, b'Z': on_bus_synced}
+BUS.on_gap = on_bus_gap
+BUS.on_tick = SEQUENCER.expire
+
+def message_marks():
+    marks = {name: (db.conn().execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_messages'").fetchone() or (0,))[0] for name, db in MESSAGE_DBS.items()}
+    if EPHEMERAL_IN_MEMORY: marks['memory'] = MESSAGE_IDS.take(0)
+    return marks
+
+def forget_room(room_id):
+    CACHE.drop(room_id)
+    for table in (ROOM_KINDS, OWNER_TOKENS, PRESENCE, PRESENCE_DIRTY): table.pop(room_id, None)
+
+def rooms_changed():
+    ROOM_DIRECTORY.invalidate()
+    BUS.publish(b'R')
+
+def room_destroyed(room_id):
+    forget_room(room_id)
+    BUS.publish(b'G', room_id.encode())
+    notify_room(room_id)
+
+def mark_present(room_id, now):
+    PRESENCE[room_id] = now
+    PRESENCE_DIRTY[room_id] = now
+    BUS.publish(b'B', room_id.encode(), struct.pack('>d', now))
+
+def flush_presence():
+    dirty = list(PRESENCE_DIRTY.items())
+    PRESENCE_DIRTY.clear()
+    if dirty:
+        EPHEMERAL.touch_rooms(dirty)
+        STORE.touch_rooms(dirty)
+
+def prune_presence(now):
+    for room_id, beat in list(PRESENCE.items()):
+        if beat < now - 600:
+            for table in (ROOM_KINDS, OWNER_TOKENS, PRESENCE): table.pop(room_id, None)
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def acquire_lease(conn, name, ttl):
+    now = time.time()
+    res = conn.execute('INSERT INTO leases (name, owner, expires_at) VALUES (?,?,?) ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at WHERE leases.owner = excluded.owner OR leases.expires_at < ?', (name, worker_id(), now + ttl, now))
+    conn.commit()
+    return res.rowcount == 1
+
+def purge_batched(conn, table, where, params, on_purged=None):
+    purged = 0
+    while True:
+        ids = conn.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?) RETURNING id', (*params, SWEEP_BATCH)).fetchall()
+        conn.commit()
+        if on_purged: on_purged([row[0] for row in ids])
+        purged += len(ids)
+        if len(ids) < SWEEP_BATCH: return purged
+
+def record_sweep(conn, task, purged, started):
+    conn.execute('INSERT INTO sweep_stats (task, runs, purged, last_purged, last_run, last_duration) VALUES (?,1,?,?,?,?) ON CONFLICT(task) DO UPDATE SET runs = runs + 1, purged = purged + excluded.purged, last_purged = excluded.last_purged, last_run = excluded.last_run, last_duration = excluded.last_duration', (task, purged, purged, started, time.time() - started))
+    conn.commit()
+
+def sweep_task(conn, task, now=None):
+    table, where, cutoff, _ = SWEEP_TASKS[task]
+    started = time.time()
+    params = cutoff(started if now is None else now)
+    purged = sum(purge_batched(db.conn(), table, where, params, SWEEP_HOOKS.get(task)) for db in DATABASES.values() if table in db.tables)
+    if task == 'attachments': remove_stale_uploads(started - 3600)
+    record_sweep(conn, task, purged, started)
+
+def file_size(path):
+    try: return os.path.getsize(path)
+    except OSError: return 0
+
+def checkpoint_wal(db):
+    size, conn = file_size(db.path + '-wal'), db.conn()
+    if size < WAL_CHECKPOINT_BYTES: return 0
+    if size < WAL_TRUNCATE_BYTES: return conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()[2]
+    conn.execute('PRAGMA busy_timeout = 250')
+    try: return conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[2]
+    finally: conn.execute('PRAGMA busy_timeout = 10000')
+
+def vacuum_free_pages(db):
+    conn = db.conn()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2: return 0
+    freed, deadline = 0, time.monotonic() + VACUUM_BUDGET
+    while time.monotonic() < deadline:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free <= VACUUM_KEEP_FREE: break
+        conn.execute(f'PRAGMA incremental_vacuum({min(free - VACUUM_KEEP_FREE, VACUUM_STEP_PAGES)})').fetchall()
+        conn.commit()
+        freed += free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return freed
+
+MAINTENANCE_TASKS = {'checkpoint': (checkpoint_wal, CHECKPOINT_INTERVAL), 'vacuum': (vacuum_free_pages, VACUUM_INTERVAL)}
+
+def maintain_storage(conn, task):
+    started = time.time()
+    record_sweep(conn, task, sum(MAINTENANCE_TASKS[task][0](db) for db in DATABASES.values()), started)
+
+def database_report(db):
+    conn = db.conn()
+    page_size, page_count, free_pages, mode = (conn.execute(f'PRAGMA {name}').fetchone()[0] for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'))
+    return {'path': db.path, 'auto_vacuum': ('none', 'full', 'incremental')[mode], 'page_size': page_size, 'page_count': page_count, 'free_pages': free_pages, 'free_bytes': free_pages * page_size, 'db_bytes': file_size(db.path), 'wal_bytes': file_size(db.path + '-wal')}
+
+def storage_report():
+    return {db.name: database_report(db) for db in DATABASES.values()}
+
+def attachment_path(attachment_id):
+    return os.path.join(ATTACHMENT_DIR, attachment_id)
+
+def remove_attachment_files(ids):
+    for attachment_id in ids:
+        try: os.unlink(attachment_path(attachment_id))
+        except FileNotFoundError: pass
+
+def remove_stale_uploads(cutoff):
+    for entry in os.scandir(ATTACHMENT_DIR):
+        if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+            try: os.unlink(entry.path)
+            except FileNotFoundError: pass
+
+SWEEP_HOOKS = {'attachments': remove_attachment_files}
+
+def sweeper_loop():
+    due = {}
+    next_flush = time.time() + PRESENCE_FLUSH
+    while True:
+        try:
+            METRICS.dump()
+            RATE_STORE.purge(time.time())
+            prune_presence(time.time())
+            if EPHEMERAL_IN_MEMORY: EPHEMERAL.expire(time.time())
+            conn = get_db()
+            if time.time() >= next_flush:
+                flush_presence()
+                next_flush = time.time() + PRESENCE_FLUSH
+            if acquire_lease(conn, 'sweeper', SWEEP_LEASE):
+                now = time.time()
+                for task, (_, _, _, interval) in SWEEP_TASKS.items():
+                    if due.get(task, 0) <= now:
+                        sweep_task(conn, task)
+                        due[task] = now + interval
+                for task, (_, interval) in MAINTENANCE_TASKS.items():
+                    if due.get(task, 0) <= now:
+                        maintain_storage(conn, task)
+                        due[task] = now + interval
+            else: due.clear()
+        except Exception as e: app.logger.warning('sweeper: %s', e)
+        time.sleep(SWEEP_TICK)
+
+def start_background():
+    global BACKGROUND_PID
+    with BACKGROUND_LOCK:
+        if BACKGROUND_PID == os.getpid(): return
+        SEQUENCER.reset(message_marks())
+        BUS.start()
+        if EPHEMERAL_IN_MEMORY and BUS.sock: sync_temp_rooms()
+        BACKGROUND_PID = os.getpid()
+    atexit.register(flush_presence)
+    threading.Thread(target=sweeper_loop, name='sweeper', daemon=True).start()
+
+@app.before_request
+def ensure_background():
+    if BACKGROUND_PID != os.getpid(): start_background()
+
+def start_timer():
+    request.environ['metrics.started'] = time.perf_counter()
+
+def record_request(resp):
+    req = request._get_current_object()
+    started = req.environ.get('metrics.started')
+    if started is not None:
+        route = req.url_rule.rule if req.url_rule else 'unmatched'
+        METRICS.observe('http_request_duration_seconds', (('route', route),), time.perf_counter() - started)
+        METRICS.inc('http_requests_total', (('route', route), ('status', str(resp.status_code))))
+    return resp
+
+if METRICS_ENABLED:
+    app.before_request(start_timer)
+    app.after_request(record_request)
+
+class Admission:
+    def __init__(self, total, classes):
+        self.lock = threading.Lock()
+        self.total = total
+        self.classes = classes
+        self.inflight = dict.fromkeys(classes, 0)
+        self.busy = 0
+
+    def enter(self, name):
+        limit, share, _ = self.classes[name]
+        with self.lock:
+            if self.inflight[name] >= limit or self.busy >= self.total * share or write_backlog() >= ADMISSION_WRITE_BACKLOG * share: return False
+            self.inflight[name] += 1
+            self.busy += 1
+            return True
+
+    def leave(self, name):
+        with self.lock:
+            self.inflight[name] -= 1
+            self.busy -= 1
+
+    def rejoin(self, name):
+        with self.lock:
+            self.inflight[name] += 1
+            self.busy += 1
+
+    def load(self):
+        return max(self.busy / self.total, write_backlog() / ADMISSION_WRITE_BACKLOG)
+
+ADMISSION = Admission(ADMISSION_TOTAL, ADMISSION_CLASSES)
+
+def admit_request():
+    req = request._get_current_object()
+    name = ROUTE_CLASSES.get(req.endpoint)
+    if name is None: return
+    if not ADMISSION.enter(name):
+        METRICS.inc('admission_rejected_total', (('class', name),))
+        resp = jsonify({'error': '服务器繁忙，请稍后再试'})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = str(ADMISSION_CLASSES[name][2])
+        return resp
+    req.environ['admission.class'] = name
+
+def release_admission(exc):
+    name = request.environ.pop('admission.class', None)
+    if name: ADMISSION.leave(name)
+
+def wait_parked(cond, timeout):
+    name = request.environ.get('admission.class')
+    if name: ADMISSION.leave(name)
+    try: cond.wait(timeout)
+    finally:
+        if name: ADMISSION.rejoin(name)
+
+if ADMISSION_ENABLED:
+    app.before_request(admit_request)
+    app.teardown_request(release_admission)
+
+def poll_delay(active, held):
+    busy = min(max(ADMISSION.load() - 0.5, 0) * 2, 1)
+    base = 0 if held else POLL_INTERVAL * (1 if active else 2)
+    return min(POLL_DELAY_MAX, base + busy * POLL_DELAY_MAX)
+
+def with_poll_delay(resp, active, held):
+    resp.headers['X-Poll-Delay'] = str(int(poll_delay(active, held) * 1000))
+    return resp
+
+def worker_gauges():
+    cache = CACHE.snapshot()
+    yield 'cache_rooms', (), cache['rooms']
+    yield 'cache_messages', (), cache['messages']
+    yield 'cache_bytes', (), cache['bytes']
+    for db in DATABASES.values(): yield 'writer_queue_depth', (('db', db.name),), db.writer.pending()
+    for name, count in list(ADMISSION.inflight.items()): yield 'admission_inflight', (('class', name),), count
+    yield 'long_polls_waiting', (('transport', 'wsgi'),), sum(sig['waiters'] for sig in list(ROOM_SIGNALS.values()))
+    if RATE_LIMIT_BACKEND == 'memory': yield 'rate_limit_keys', (), RATE_STORE.size()
+
+GAUGE_PROVIDERS.append(worker_gauges)
+
+def shared_series():
+    now = time.time()
+    yield 'gauge', 'rooms_active', (('kind', 'public'),), len(ROOM_DIRECTORY.snapshot())
+    yield 'gauge', 'rooms_active', (('kind', 'temp'),), sum(1 for beat in list(PRESENCE.values()) if now - beat <= PRESENCE_TIMEOUT)
+    for db in DATABASES.values():
+        if 'chat_messages' in db.tables: yield 'gauge', 'messages_pending', (('engine', 'sqlite'), ('db', db.name)), db.conn().execute('SELECT count(*) FROM chat_messages WHERE created_at > ?', (now - MESSAGE_TTL,)).fetchone()[0]
+    if EPHEMERAL_IN_MEMORY: yield 'gauge', 'messages_pending', (('engine', 'memory'),), EPHEMERAL.message_count(now - MESSAGE_TTL)
+    if RATE_LIMIT_BACKEND == 'sqlite': yield 'gauge', 'rate_limit_keys', (), RATE_STORE.size()
+    for db, report in storage_report().items():
+        for name in ('db_bytes', 'wal_bytes', 'free_bytes'): yield 'gauge', 'storage_' + name, (('db', db),), report[name]
+    for row in get_db().execute('SELECT task, runs, purged FROM sweep_stats'):
+        yield 'counter', 'sweeper_runs_total', (('task', row['task']),), row['runs']
+        yield 'counter', 'sweeper_purged_total', (('task', row['task']),), row['purged']
+
+def metric_labels(labels, *extra):
+    pairs = [*labels, *extra]
+    return '{' + ','.join(f'{key}={json.dumps(str(value), ensure_ascii=False)}' for key, value in pairs) + '}' if pairs else ''
+
+def render_metrics(snapshots, shared):
+    series = {'counter': {}, 'gauge': {}}
+    histograms = {}
+    for snap in snapshots:
+        for kind, rows in (('counter', snap['counters']), ('gauge', snap['gauges'])):
+            for name, labels, value in rows:
+                key = (name, tuple(map(tuple, labels)))
+                series[kind][key] = series[kind].get(key, 0) + value
+        for name, labels, hist in snap['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            histograms[key] = [a + b for a, b in zip(histograms[key], hist)] if key in histograms else hist
+    series['gauge'][('workers', ())] = len(snapshots)
+    for kind, name, labels, value in shared: series[kind][(name, labels)] = value
+    lines = []
+    for kind, values in series.items():
+        for name in sorted({name for name, _ in values}):
+            lines.append(f'# TYPE {METRICS_PREFIX}{name} {kind}')
+            lines += [f'{METRICS_PREFIX}{name}{metric_labels(labels)} {value}' for (key, labels), value in sorted(values.items()) if key == name]
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+        for (key, labels), hist in sorted(histograms.items()):
+            if key != name: continue
+            total = 0
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), hist):
+                total += count
+                lines.append(f'{METRICS_PREFIX}{name}_bucket{metric_labels(labels, ("le", bound))} {total}')
+            lines.append(f'{METRICS_PREFIX}{name}_sum{metric_labels(labels)} {hist[-1]}')
+            lines.append(f'{METRICS_PREFIX}{name}_count{metric_labels(labels)} {total}')
+    return '\n'.join(lines) + '\n'
+
+def json_bytes(obj):
+    if orjson:
+        try: return orjson.dumps(obj, default=DefaultJSONProvider.default)
+        except TypeError: pass
+    return JSON_ENCODER.encode(obj).encode()
+
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=DefaultJSONProvider.default)
+
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return json_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s) if orjson else json.loads(s)
+
+    def response(self, *args, **kwargs):
+        return json_body(json_bytes(self._prepare_response_obj(args, kwargs)))
+
+app.json = FastJSONProvider(app)
+
+def json_body(body, status=200):
+    return app.response_class(body, status, mimetype='application/json')
+
+REQUIRED = object()
+SCHEMAS = {
+    'note_create': {'ciphertext': ('b64', MAX_CIPHERTEXT, REQUIRED), 'iv': ('b64', 64, REQUIRED), 'salt': ('b64', 64, None), 'expire_hours': ('int', (1, 720), 24), 'burn_mode': ('int', (0, 1), 1)},
+    'chat_send': {'room_id': ('str', 64, REQUIRED), 'ciphertext': ('b64', MAX_CIPHERTEXT, REQUIRED), 'iv': ('b64', 64, REQUIRED), 'sender_id': ('text', 32, 'anon')},
+    'room_create': {'name': ('text', 30, REQUIRED), 'salt': ('str', 64, REQUIRED), 'admin_code': ('str', 256, REQUIRED)},
+    'room_delete': {'room_id': ('str', 64, REQUIRED), 'admin_code': ('str', 256, None), 'owner_token': ('str', 64, None)},
+    'heartbeat': {'room_id': ('str', 64, REQUIRED), 'owner_token': ('str', 64, REQUIRED)},
+    'attachment_upload': {'room_id': ('str', 64, None), 'expire_hours': ('int', (1, 720), 24), 'burn_mode': ('int', (0, 1), 1)},
+}
+
+class PayloadError(Exception):
+    def __init__(self, message='格式错误', status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(PayloadError)
+def payload_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+def decode_field(kind, limit, value):
+    if kind == 'b64':
+        if isinstance(value, str):
+            if len(value) > (limit + 2) // 3 * 4: raise PayloadError('内容过长', 413)
+            try: value = base64.b64decode(value, validate=True)
+            except ValueError: raise PayloadError()
+        if not isinstance(value, bytes): raise PayloadError()
+        if len(value) > limit: raise PayloadError('内容过长', 413)
+        return value
+    if kind == 'int':
+        if isinstance(value, str) and value.lstrip('-').isdigit(): value = int(value)
+        if type(value) is not int or not limit[0] <= value <= limit[1]: raise PayloadError()
+        return value
+    if not isinstance(value, str) or kind == 'str' and len(value) > limit: raise PayloadError()
+    return value[:limit]
+
+def decode_payload(schema, data):
+    if not isinstance(data, dict): raise PayloadError()
+    fields = {}
+    for key, (kind, limit, default) in SCHEMAS[schema].items():
+        value = data.get(key)
+        if value is None or value == '' or value == b'':
+            if default is REQUIRED: raise PayloadError()
+            fields[key] = default
+        else: fields[key] = decode_field(kind, limit, value)
+    return fields
+
+def decode_request(schema, frame=()):
+    if frame and is_binary_request():
+        try: parts = unpack_frame(request.get_data(), len(frame))
+        except ValueError: raise PayloadError()
+        return decode_payload(schema, {**request.args.to_dict(), **dict(zip(frame, parts))})
+    return decode_payload(schema, request.get_json(silent=True))
+
+def b64_text(val):
+    if val is None or isinstance(val, str): return val
+    return base64.b64encode(val).decode()
+
+def pack_frame(*parts):
+    return b''.join(struct.pack('>I', len(part)) + part for part in parts)
+
+def unpack_frame(data, count):
+    parts, pos = [], 0
+    for _ in range(count):
+        if pos + 4 > len(data): raise ValueError('truncated frame')
+        (size,) = struct.unpack_from('>I', data, pos)
+        pos += 4
+        if pos + size > len(data): raise ValueError('truncated frame')
+        parts.append(data[pos:pos + size])
+        pos += size
+    if pos != len(data): raise ValueError('trailing bytes in frame')
+    return parts
+
+def is_binary_request():
+    return request.mimetype == BINARY_MIME
+
+def wants_binary():
+    return request.accept_mimetypes.best_match(['application/json', BINARY_MIME]) == BINARY_MIME
+
+def binary_response(body):
+    return make_response(body, 200, {'Content-Type': BINARY_MIME})
+
+class StaticAsset:
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli: self.variants['br'] = brotli.compress(body, quality=11)
+
+def read_static(name):
+    with open(os.path.join(STATIC_DIR, name), 'rb') as f: return f.read()
+
+def build_assets():
+    assets = {}
+    for name, mimetype in (('app.css', 'text/css; charset=utf-8'), ('app.js', 'text/javascript; charset=utf-8')):
+        asset = StaticAsset(read_static(name), mimetype)
+        stem, ext = name.rsplit('.', 1)
+        assets[f'{stem}.{asset.etag}.{ext}'] = asset
+    shell = read_static('index.html').decode()
+    for hashed in assets: shell = shell.replace('__APP_%s__' % hashed.rsplit('.', 1)[1].upper(), '/assets/' + hashed)
+    return StaticAsset(shell.encode(), 'text/html; charset=utf-8'), assets
+
+SHELL, ASSETS = build_assets()
+
+def serve_asset(asset, cache_control):
+    encoding = next((enc for enc in ('br', 'gzip') if enc in asset.variants and request.accept_encodings[enc]), 'identity')
+    etag = f'{asset.etag}-{encoding}'
+    if request.if_none_match.contains(etag): resp = make_response('', 304)
+    else:
+        resp = make_response(asset.variants[encoding])
+        resp.mimetype = asset.mimetype
+        if encoding != 'identity': resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+@app.route('/')
 @app.route('/chat/<room_id>')
-def chat_page(room_id): return HTML_LAYOUT
+@app.route('/note/<id>')
+def index(room_id=None, id=None): return serve_asset(SHELL, 'no-cache')
+
+@app.route('/assets/<name>')
+def static_asset(name):
+    asset = ASSETS.get(name)
+    if not asset: return jsonify({'error': 'not found'}), 404
+    return serve_asset(asset, 'public, max-age=31536000, immutable')
+
+@app.route('/api/note/meta/<id>')
+def note_meta(id):
+    meta = STORE.note_meta(id, int(time.time()))
+    if not meta: return jsonify({'error': 'Not found'}), 404
+    return jsonify(meta)
 
 @app.route('/api/rooms')
 def list_rooms():
-    clean_zombies()
-    conn = get_db()
-    since = time.time() - 86400 
-    rows = conn.execute('SELECT id, name, created_at, salt FROM rooms WHERE is_public = 1 AND created_at > ? ORDER BY created_at DESC', (since,)).fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in rows])
+    since = time.time() - 86400
+    rooms = [room for room in ROOM_DIRECTORY.snapshot() if room['created_at'] > since]
+    if 'limit' in request.args:
+        try: limit, before = min(max(int(request.args['limit']), 1), 100), float(request.args.get('before', 'inf'))
+        except ValueError: return jsonify({'error': '参数错误'}), 400
+        page = [room for room in rooms if room['created_at'] < before][:limit + 1]
+        resp = jsonify({'rooms': page[:limit], 'next': page[limit - 1]['created_at'] if len(page) > limit else None})
+    else: resp = jsonify(rooms)
+    resp.add_etag()
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
 
 @app.route('/api/room/create_public', methods=['POST'])
 def create_public_room():
-    ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    now = time.time()
-    last = ADMIN_LIMITS.get(ip, 0)
-    if now - last < 3: return jsonify({'error': '操作太快'}), 429
-    ADMIN_LIMITS[ip] = now
-    clean_zombies()
-    data = request.json
-    if data.get('admin_code') != ADMIN_CODE: return jsonify({'error': '管理员口令错误'}), 403
-    name = validate_str(data.get('name'), 30, "Room")
-    if not name: return jsonify({'error': '名称不能为空'}), 400
+    data = decode_request('room_create')
+    if rate_limited('admin'): return jsonify({'error': '操作太快'}), 429
+    if data['admin_code'] != ADMIN_CODE: return jsonify({'error': '管理员口令错误'}), 403
     uid = str(uuid.uuid4()).replace('-', '')
-    conn = get_db()
-    conn.execute('INSERT INTO rooms (id, name, is_public, salt, created_at, last_active) VALUES (?,?,?,?,?,?)', (uid, name, 1, data['salt'], time.time(), time.time()))
-    conn.commit()
-    conn.close()
+    STORE.create_room({'id': uid, 'name': data['name'], 'is_public': 1, 'salt': data['salt'], 'created_at': time.time(), 'owner_token': None, 'last_active': time.time()})
+    ROOM_KINDS[uid] = 1
+    rooms_changed()
     return jsonify({'id': uid})
 
 @app.route('/api/room/create_temp', methods=['POST'])
 def create_temp_room():
-    clean_zombies()
-    ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    now = time.time()
-    last = CREATION_LIMITS.get(ip, 0)
-    if now - last < 60: return jsonify({'error': '每分钟限建一个房间'}), 429
-    CREATION_LIMITS[ip] = now
+    if rate_limited('create_temp'): return jsonify({'error': '每分钟限建一个房间'}), 429
     uid = str(uuid.uuid4()).replace('-', '')
     owner_token = str(uuid.uuid4())
-    conn = get_db()
-    conn.execute('INSERT INTO rooms (id, name, is_public, salt, created_at, owner_token, last_active) VALUES (?,?,?,?,?,?,?)', 
-                 (uid, '临时房间', 0, '', time.time(), owner_token, time.time()))
-    conn.commit()
-    conn.close()
+    now = time.time()
+    EPHEMERAL.create_room({'id': uid, 'name': '临时房间', 'is_public': 0, 'salt': '', 'created_at': now, 'owner_token': owner_token, 'last_active': now})
+    if EPHEMERAL_IN_MEMORY: BUS.publish(b'T', uid.encode(), owner_token.encode(), struct.pack('>d', now))
+    ROOM_KINDS[uid], OWNER_TOKENS[uid], PRESENCE[uid] = 0, owner_token, now
     return jsonify({'id': uid, 'owner_token': owner_token})
 
+def touch_room(room_id, token):
+    if not token or OWNER_TOKENS.get(room_id) != token:
+        if not room_store(room_id).is_owner(room_id, token): return False
+        OWNER_TOKENS[room_id] = token
+    mark_present(room_id, time.time())
+    return True
+
 @app.route('/api/room/heartbeat', methods=['POST'])
 def room_heartbeat():
-    data = request.json
-    room_id = data.get('room_id')
-    token = data.get('owner_token')
-    conn = get_db()
-    res = conn.execute('UPDATE rooms SET last_active = ? WHERE id = ? AND owner_token = ?', (time.time(), room_id, token))
-    conn.commit()
-    conn.close()
-    if res.rowcount == 0: return jsonify({'status': 'failed'}), 403
+    data = decode_request('heartbeat')
+    if not touch_room(data['room_id'], data['owner_token']): return jsonify({'status': 'failed'}), 403
     return jsonify({'status': 'ok'})
 
 @app.route('/api/room/info/<id>')
 def room_info(id):
-    conn = get_db()
-    row = conn.execute('SELECT salt FROM rooms WHERE id = ?', (id,)).fetchone()
-    conn.close()
-    if row: return jsonify(dict(row))
+    salt = room_store(id).room_salt(id)
+    if salt is not None: return jsonify({'salt': salt})
     return jsonify({'error': 'not found'})
 
 @app.route('/api/room/delete', methods=['POST'])
 def delete_room():
-    data = request.json
-    conn = get_db()
+    data = decode_request('room_delete')
     can_delete = False
-    if data.get('admin_code') == ADMIN_CODE: can_delete = True
-    elif data.get('owner_token'):
-        row = conn.execute('SELECT 1 FROM rooms WHERE id = ? AND owner_token = ?', (data['room_id'], data['owner_token'])).fetchone()
-        if row: can_delete = True
+    if data['admin_code'] == ADMIN_CODE: can_delete = True
+    elif data['owner_token']:
+        if room_store(data['room_id']).is_owner(data['room_id'], data['owner_token']): can_delete = True
     if can_delete:
-        conn.execute('DELETE FROM rooms WHERE id = ?', (data['room_id'],))
-        conn.execute('DELETE FROM chat_messages WHERE room_id = ?', (data['room_id'],))
-        conn.commit()
-        conn.close()
+        destroy_room(data['room_id'])
+        rooms_changed()
         return jsonify({'status': 'ok'})
-    conn.close()
     return jsonify({'error': '无权删除'}), 403
 
+def live_rooms(room_ids):
+    unknown = [room_id for room_id in room_ids if ROOM_KINDS.get(room_id) is None or (ROOM_KINDS[room_id] == 0 and room_id not in PRESENCE)]
+    if unknown:
+        rows = list(EPHEMERAL.room_states(unknown))
+        unknown = [room_id for room_id in unknown if room_id not in {row['id'] for row in rows}]
+        for row in rows + (list(STORE.room_states(unknown)) if unknown else []):
+            ROOM_KINDS[row['id']] = row['is_public']
+            if row['is_public'] == 0: PRESENCE.setdefault(row['id'], row['last_active'] + PRESENCE_FLUSH)
+    live = []
+    for room_id in room_ids:
+        kind = ROOM_KINDS.get(room_id)
+        if kind is None: continue
+        if kind == 0 and time.time() - PRESENCE.get(room_id, 0) > PRESENCE_TIMEOUT: destroy_room(room_id)
+        else: live.append(room_id)
+    return live
+
+def destroy_room(room_id):
+    room_store(room_id).delete_room(room_id)
+    remove_attachment_files(STORE.drop_room_attachments(room_id))
+    room_destroyed(room_id)
+
+def fetch_messages(room_id, after=0, last_time=0.0):
+    if not live_rooms([room_id]): return None
+    msgs = CACHE.read(room_id, after, last_time)
+    if msgs is None:
+        since = time.time() - MESSAGE_TTL
+        msgs = prime_messages(room_id, recent_messages(room_store(room_id), [room_id], since), since, after, last_time)
+    return msgs
+
+def recent_messages(store, room_ids, since):
+    rows = store.recent_messages(room_ids, since)
+    return SEQUENCER.settled('memory', rows) if store is EPHEMERAL and EPHEMERAL_IN_MEMORY else rows
+
+def prime_messages(room_id, rows, since, after, last_time):
+    CACHE.prime(room_id, rows, since)
+    msgs = CACHE.read(room_id, after, last_time)
+    if msgs is None: msgs = sorted((row for row in rows if row['id'] > after and row['created_at'] > last_time), key=lambda row: row['id'])
+    return msgs
+
+def fetch_messages_batch(cursors):
+    live = {room_id: CACHE.read(room_id, *cursors[room_id]) for room_id in live_rooms(list(cursors))}
+    missing = [room_id for room_id, msgs in live.items() if msgs is None]
+    if missing:
+        since = time.time() - MESSAGE_TTL
+        by_store = {}
+        for room_id in missing: by_store.setdefault(room_store(room_id), []).append(room_id)
+        rows = [row for store, room_ids in by_store.items() for row in recent_messages(store, room_ids, since)]
+        for room_id in missing: live[room_id] = prime_messages(room_id, [row for row in rows if row['room_id'] == room_id], since, *cursors[room_id])
+    return live
+
+def pack_messages(rows):
+    return b''.join(struct.pack('>d', row['created_at']) + pack_frame((row['sender_id'] or '').encode(), row['iv'], row['ciphertext']) for row in rows)
+
+def messages_response(rows):
+    if wants_binary(): return binary_response(pack_messages(rows))
+    return json_body(messages_body(rows))
+
+def pack_compact(rows):
+    senders = list(dict.fromkeys(row['sender_id'] or '' for row in rows))
+    index = {sender: i for i, sender in enumerate(senders)}
+    return struct.pack('>H', len(senders)) + pack_frame(*[sender.encode() for sender in senders]) + b''.join(struct.pack('>QdH', row['id'], row['created_at'], index[row['sender_id'] or '']) + pack_frame(row['iv'], row['ciphertext']) for row in rows)
+
+def compact_body(rows):
+    senders = list(dict.fromkeys(row['sender_id'] or '' for row in rows))
+    index = {sender: i for i, sender in enumerate(senders)}
+    b64 = base64.b64encode
+    return b'{"senders":%s,"messages":[%s]}' % (json_bytes(senders), b','.join(b'[%d,%r,%d,"%s","%s"]' % (row['id'], row['created_at'], index[row['sender_id'] or ''], b64(row['iv']), b64(row['ciphertext'])) for row in rows))
+
+def compact_response(rows):
+    if not rows: return make_response('', 204)
+    if wants_binary(): return binary_response(pack_compact(rows))
+    return json_body(compact_body(rows))
+
+def messages_body(rows):
+    senders = {sender: json_bytes(sender) for sender in {row['sender_id'] for row in rows}}
+    b64 = base64.b64encode
+    return b'[%s]' % b','.join(b'{"ciphertext":"%s","iv":"%s","created_at":%r,"sender_id":%s}' % (b64(row['ciphertext']), b64(row['iv']), row['created_at'], senders[row['sender_id']]) for row in rows)
+
+def room_gone_response():
+    if wants_binary(): return make_response(b'', 410)
+    return jsonify({'status': 'room_gone'})
+
+def store_messages(msgs):
+    now = time.time()
+    ephemeral = {room_id for room_id in {msg[0] for msg in msgs} if room_store(room_id) is not STORE}
+    delivered = []
+    def deliver(source, entries):
+        SEQUENCER.deliver(source, entries)
+        delivered.append((source, entries))
+    for store, rows in ((STORE, [msg for msg in msgs if msg[0] not in ephemeral]), (EPHEMERAL, [msg for msg in msgs if msg[0] in ephemeral])):
+        if rows: store.add_messages([(room_id, ciphertext, iv, now, sender_id) for room_id, ciphertext, iv, sender_id in rows], deliver)
+    for source, entries in delivered:
+        for entry in entries: BUS.publish(b'M', struct.pack('>Q', entry['id']), entry['room_id'].encode(), struct.pack('>d', entry['created_at']), entry['sender_id'].encode(), entry['iv'], entry['ciphertext'], source.encode())
+
 @app.route('/api/chat/poll/<room_id>')
 def poll_chat(room_id):
-    random_clean()
-    conn = get_db()
-    room = conn.execute('SELECT is_public, last_active FROM rooms WHERE id = ?', (room_id,)).fetchone()
-    if not room:
-        conn.close()
-        return jsonify({'status': 'room_gone'})
-    if room['is_public'] == 0:
-        if time.time() - room['last_active'] > 8:
-            conn.execute('DELETE FROM rooms WHERE id = ?', (room_id,))
-            conn.execute('DELETE FROM chat_messages WHERE room_id = ?', (room_id,))
-            conn.commit()
-            conn.close()
-            return jsonify({'status': 'room_gone'})
-    last_time = float(request.args.get('last', 0))
-    now = time.time()
-    rows = conn.execute('SELECT ciphertext, iv, created_at, sender_id FROM chat_messages WHERE room_id = ? AND created_at > ?', (room_id, last_time)).fetchall()
-    conn.execute('DELETE FROM chat_messages WHERE created_at < ?', (now - 300,))
-    conn.commit()
-    conn.close()
-    return jsonify([dict(row) for row in rows])
+    try:
+        after = int(request.args['after']) if 'after' in request.args else None
+        last_time = float(request.args.get('last', 0))
+        wait = min(max(float(request.args.get('wait', 0)), 0), POLL_WAIT_MAX)
+    except ValueError: return jsonify({'error': '参数错误'}), 400
+    encode = messages_response if after is None else compact_response
+    held = wait > 0 or request.args.get('held') == '1'
+    respond = lambda msgs: with_poll_delay(encode(msgs), bool(msgs) or time.time() - CACHE.last_activity(room_id) < POLL_QUIET_AFTER, held)
+    if wait <= 0:
+        msgs = fetch_messages(room_id, after or 0, last_time)
+        return room_gone_response() if msgs is None else respond(msgs)
+    deadline = time.time() + wait
+    sig = acquire_room_signal(room_id)
+    try:
+        while True:
+            seq = sig['seq']
+            msgs = fetch_messages(room_id, after or 0, last_time)
+            if msgs is None: return room_gone_response()
+            remaining = deadline - time.time()
+            if msgs or remaining <= 0: return respond(msgs)
+            with sig['cond']:
+                if sig['seq'] == seq: wait_parked(sig['cond'], min(remaining, POLL_RECHECK))
+    finally:
+        release_room_signal(room_id, sig)
+
+@app.route('/api/chat/poll_batch', methods=['POST'])
+def poll_chat_batch():
+    try: cursors = {str(c['room_id']): (int(c['after']) if 'after' in c else None, float(c.get('last', 0))) for c in request.json['cursors']}
+    except (KeyError, TypeError, ValueError, AttributeError): return jsonify({'error': '格式错误'}), 400
+    if not cursors: return jsonify({'rooms': {}})
+    if len(cursors) > BATCH_MAX: return jsonify({'error': '房间过多'}), 413
+    live = fetch_messages_batch({room_id: (after or 0, last_time) for room_id, (after, last_time) in cursors.items()})
+    def encode(room_id):
+        if room_id not in live: return b'{"status":"room_gone"}'
+        if cursors[room_id][0] is None: return messages_body(live[room_id])
+        return compact_body(live[room_id])
+    active = any(live.values()) or any(time.time() - CACHE.last_activity(room_id) < POLL_QUIET_AFTER for room_id in live)
+    return with_poll_delay(json_body(b'{"rooms":{%s}}' % b','.join(json_bytes(room_id) + b':' + encode(room_id) for room_id in cursors)), active, False)
 
 @app.route('/api/note/create', methods=['POST'])
 def create_note_api():
-    clean_zombies()
-    data = request.json
-    if len(data.get('ciphertext', '')) > 20000: return jsonify({'error': '内容过长'}), 413
+    data = decode_request('note_create', ('iv', 'salt', 'ciphertext'))
     uid = str(uuid.uuid4()).replace('-', '')
-    expire = datetime.datetime.now() + datetime.timedelta(hours=int(data.get('expire_hours', 24)))
-    burn_mode = int(data.get('burn_mode', 1))
-    conn = get_db()
-    conn.execute('INSERT INTO secrets (id, ciphertext, iv, salt, expire_at, burn_mode) VALUES (?,?,?,?,?,?)', (uid, data['ciphertext'], data['iv'], data['salt'], expire, burn_mode))
-    conn.commit()
-    conn.close()
+    STORE.create_note(uid, data['ciphertext'], data['iv'], data['salt'], int(time.time()) + data['expire_hours'] * 3600, data['burn_mode'])
     return jsonify({'id': uid})
 
 @app.route('/api/note/read/<id>', methods=['POST'])
 def read_note_api(id):
-    conn = get_db()
-    row = conn.execute('SELECT * FROM secrets WHERE id = ?', (id,)).fetchone()
-    if row:
-        if row['burn_mode'] == 1: conn.execute('DELETE FROM secrets WHERE id = ?', (id,))
-        else:
-            if datetime.datetime.strptime(row['expire_at'], '%Y-%m-%d %H:%M:%S.%f') < datetime.datetime.now():
-                conn.execute('DELETE FROM secrets WHERE id = ?', (id,))
-                conn.commit()
-                conn.close()
-                return jsonify({'error': 'Expired'}), 410
-        conn.commit()
-    conn.close()
+    now = int(time.time())
+    burn_read = lambda: STORE.take_note(id, now)
+    timed_read = lambda: STORE.peek_note(id, now)
+    first, second = (timed_read, burn_read) if request.args.get('burn') == '0' else (burn_read, timed_read)
+    row = first() or second()
     if not row: return jsonify({'error': 'Not found'}), 404
-    return jsonify({'ciphertext': row['ciphertext'], 'iv': row['iv'], 'salt': row['salt']})
+    if wants_binary(): return binary_response(pack_frame(row['iv'], row['salt'] or b'', row['ciphertext']))
+    return jsonify({'ciphertext': b64_text(row['ciphertext']), 'iv': b64_text(row['iv']), 'salt': b64_text(row['salt'])})
 
 @app.route('/api/chat/send', methods=['POST'])
 def send_chat():
-    random_clean()
-    ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    now = time.time()
-    last = MESSAGE_LIMITS.get(ip, 0)
-    if now - last < 1.0: return jsonify({'error': '发送太快'}), 429
-    MESSAGE_LIMITS[ip] = now
-    data = request.json
-    if len(data.get('ciphertext', '')) > 20000: return jsonify({'error': '内容过长'}), 413
-    sender_id = validate_str(data.get('sender_id'), 32, "anon")
-    conn = get_db()
-    conn.execute('INSERT INTO chat_messages (room_id, ciphertext, iv, created_at, sender_id) VALUES (?,?,?,?,?)', (data['room_id'], data['ciphertext'], data['iv'], time.time(), sender_id))
-    conn.commit()
-    conn.close()
+    data = decode_request('chat_send', ('iv', 'ciphertext'))
+    if rate_limited('message'): return jsonify({'error': '发送太快'}), 429
+    store_messages([(data['room_id'], data['ciphertext'], data['iv'], data['sender_id'])])
     return jsonify({'status': 'ok'})
 
+@app.route('/api/chat/send_batch', methods=['POST'])
+def send_chat_batch():
+    body = request.get_json(silent=True)
+    items = body.get('messages') if isinstance(body, dict) else None
+    if not isinstance(items, list): raise PayloadError()
+    if len(items) > BATCH_MAX: return jsonify({'error': '消息过多'}), 413
+    msgs = [(data['room_id'], data['ciphertext'], data['iv'], data['sender_id']) for data in (decode_payload('chat_send', item) for item in items)]
+    accepted = 0
+    while accepted < len(msgs) and not rate_limited('message'): accepted += 1
+    if not accepted: return jsonify({'error': '发送太快'}), 429
+    store_messages(msgs[:accepted])
+    return jsonify({'status': 'ok', 'accepted': accepted})
+
+def receive_attachment(stream, path):
+    size = 0
+    part = path + '.part'
+    try:
+        with open(part, 'wb') as f:
+            while True:
+                chunk = stream.read(ATTACHMENT_CHUNK)
+                if not chunk: break
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_BYTES: raise RequestEntityTooLarge()
+                f.write(chunk)
+        os.replace(part, path)
+    except BaseException:
+        os.unlink(part)
+        raise
+    return size
+
+def attachment_response(f, size):
+    resp = send_file(f, mimetype=BINARY_MIME, conditional=False, max_age=0)
+    resp.content_length = size
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+@app.route('/api/file/upload', methods=['POST'])
+def upload_attachment():
+    if rate_limited('upload'): return jsonify({'error': '上传太快'}), 429
+    args = decode_payload('attachment_upload', request.args.to_dict())
+    room_id = args['room_id']
+    if room_id:
+        if not live_rooms([room_id]): return jsonify({'error': '房间不存在'}), 404
+        expire, burn_mode = int(time.time()) + MESSAGE_TTL, 0
+    else: expire, burn_mode = int(time.time()) + args['expire_hours'] * 3600, args['burn_mode']
+    uid = str(uuid.uuid4()).replace('-', '')
+    try: size = receive_attachment(request.stream, attachment_path(uid))
+    except RequestEntityTooLarge: return jsonify({'error': '文件过大'}), 413
+    if not size:
+        os.unlink(attachment_path(uid))
+        return jsonify({'error': '文件为空'}), 400
+    try: STORE.create_attachment(uid, room_id, size, expire, burn_mode)
+    except Exception:
+        os.unlink(attachment_path(uid))
+        raise
+    return jsonify({'id': uid, 'size': size})
+
+@app.route('/api/file/read/<id>', methods=['POST'])
+def read_attachment(id):
+    now = int(time.time())
+    def burn_read():
+        size = STORE.take_attachment(id, now)
+        if size is None: return None
+        f = open(attachment_path(id), 'rb')
+        os.unlink(attachment_path(id))
+        return f, size
+    def timed_read():
+        size = STORE.peek_attachment(id, now)
+        return size and (open(attachment_path(id), 'rb'), size)
+    first, second = (timed_read, burn_read) if request.args.get('burn') == '0' else (burn_read, timed_read)
+    try: found = first() or second()
+    except FileNotFoundError: found = None
+    if not found: return jsonify({'error': 'Not found'}), 404
+    return attachment_response(*found)
+
+def admin_authorized():
+    return bool(ADMIN_CODE) and ADMIN_CODE in (request.headers.get('X-Admin-Code'), request.headers.get('Authorization', '').partition('Bearer ')[2])
+
+@app.route('/api/admin/cache')
+def cache_stats():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    return jsonify(dict(CACHE.snapshot(), worker=worker_id(), max_bytes=CACHE_MAX_BYTES))
+
+@app.route('/api/admin/sweeper')
+def sweeper_stats():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    conn = get_db()
+    lease = conn.execute('SELECT owner, expires_at FROM leases WHERE name = ?', ('sweeper',)).fetchone()
+    rows = conn.execute('SELECT * FROM sweep_stats').fetchall()
+    return jsonify({'leader': dict(lease) if lease else None, 'tasks': {row['task']: dict(row) for row in rows}})
+
+@app.route('/api/admin/storage')
+def storage_stats():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    return jsonify(storage_report())
+
+@app.route('/api/admin/slow_queries')
+def slow_queries():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    return jsonify({'worker': worker_id(), 'threshold_ms': SLOW_QUERY_MS or None, 'queries': list(SLOW_QUERIES)})
+
+@app.route('/api/admin/profile', methods=['GET', 'POST'])
+def profile():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    if request.method == 'GET': return jsonify({'running': PROFILER.running, 'files': PROFILER.files()})
+    try: seconds, interval = min(max(float(request.args.get('seconds', 10)), 0.1), PROFILE_MAX_SECONDS), min(max(float(request.args.get('interval_ms', 10)), 1), 1000) / 1000
+    except ValueError: return jsonify({'error': '参数错误'}), 400
+    name = PROFILER.start(seconds, interval)
+    if name is None: return jsonify({'error': '采样进行中'}), 409
+    if request.args.get('all') == '1': BUS.publish(b'P', struct.pack('>dd', seconds, interval))
+    return jsonify({'worker': worker_id(), 'file': name, 'seconds': seconds}), 202
+
+@app.route('/api/admin/profile/<name>')
+def profile_file(name):
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    if name not in {f['name'] for f in PROFILER.files()}: return jsonify({'error': 'not found'}), 404
+    return send_file(os.path.join(os.path.abspath(PROFILE_DIR), name), mimetype='text/plain', max_age=0)
+
+@app.route('/api/admin/metrics')
+def metrics():
+    if not admin_authorized(): return jsonify({'error': '管理员口令错误'}), 403
+    return make_response(render_metrics(METRICS.collect(), list(shared_series())), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+start_background()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8787)
@@ -0,0 +1,279 @@
+import asyncio
+import os
+import queue
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+import app as core
+
+DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', 32))
+BODY_BACKLOG = 16
+EXECUTOR = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='asgi-db')
+POLL_PATH = re.compile(r'^/api/chat/poll/([^/]+)$')
+SOCKET_PATH = re.compile(r'^/api/chat/ws/([^/]+)$')
+SOCKET_BACKLOG = 256
+WAITERS = {}
+FEEDS = {}
+
+class BodyStream:
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.buffer = b''
+        self.done = False
+
+    def feed(self, chunk, more):
+        self.chunks.put((chunk, more))
+
+    def fill(self, size):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk, more = self.chunks.get()
+            self.buffer += chunk
+            self.done = not more
+
+    def read(self, size=-1):
+        self.fill(size)
+        if size < 0: size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buffer and not self.done and (size < 0 or len(self.buffer) < size): self.fill(len(self.buffer) + 1)
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0: end = min(end, size)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line: return
+            yield line
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        key = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}.get(name) or 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def run_wsgi(environ, loop, send):
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        return lambda data: None
+    def push(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+    result = core.app(environ, start_response)
+    try:
+        push({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        for chunk in result:
+            if chunk: push({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        push({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'): result.close()
+
+async def pump_body(receive, body):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.feed(b'', False)
+            return
+        more = message.get('more_body', False)
+        body.feed(message.get('body', b''), more)
+        if not more: return
+        while body.chunks.qsize() >= BODY_BACKLOG: await asyncio.sleep(0.005)
+
+async def bridge(scope, receive, send):
+    body = BodyStream()
+    pump = asyncio.ensure_future(pump_body(receive, body))
+    try: await asyncio.get_running_loop().run_in_executor(EXECUTOR, run_wsgi, build_environ(scope, body), asyncio.get_running_loop(), send)
+    finally: pump.cancel()
+
+async def long_poll(scope, room_id):
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    try: after, last, wait = int(args.get('after', 0)), float(args.get('last', 0)), min(max(float(args.pop('wait', 0)), 0), core.POLL_WAIT_MAX)
+    except ValueError: return scope
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    event = asyncio.Event()
+    WAITERS.setdefault(room_id, set()).add(event)
+    try:
+        while True:
+            event.clear()
+            msgs = await loop.run_in_executor(EXECUTOR, core.fetch_messages, room_id, after, last)
+            remaining = deadline - loop.time()
+            if msgs is None or msgs or remaining <= 0: break
+            try: await asyncio.wait_for(event.wait(), min(remaining, core.POLL_RECHECK))
+            except asyncio.TimeoutError: pass
+    finally:
+        waiters = WAITERS.get(room_id)
+        waiters.discard(event)
+        if not waiters: del WAITERS[room_id]
+    if wait > 0: args['held'] = '1'
+    return dict(scope, query_string=urlencode(args).encode('latin-1'))
+
+def wake_room(room_id):
+    for event in WAITERS.get(room_id, ()): event.set()
+
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(SOCKET_BACKLOG)
+        self.lagging = False
+
+    def push(self, records):
+        if self.queue.full(): self.lagging = True
+        else: self.queue.put_nowait(records)
+
+class RoomFeed:
+    def __init__(self, room_id, after):
+        self.room_id = room_id
+        self.after = after
+        self.subscribers = set()
+        self.event = asyncio.Event()
+        WAITERS.setdefault(room_id, set()).add(self.event)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        after = self.after
+        try:
+            while self.subscribers:
+                self.event.clear()
+                msgs = await loop.run_in_executor(EXECUTOR, core.fetch_messages, self.room_id, after)
+                if msgs is None:
+                    for sub in self.subscribers: sub.push(None)
+                    return
+                if msgs:
+                    after = msgs[-1]['id']
+                    update = (msgs, b'M' + core.pack_compact(msgs))
+                    for sub in self.subscribers: sub.push(update)
+                try: await asyncio.wait_for(self.event.wait(), core.POLL_RECHECK)
+                except asyncio.TimeoutError: pass
+        finally:
+            waiters = WAITERS.get(self.room_id)
+            waiters.discard(self.event)
+            if not waiters: del WAITERS[self.room_id]
+            if FEEDS.get(self.room_id) is self: del FEEDS[self.room_id]
+
+def join_feed(room_id, sub, after):
+    feed = FEEDS.get(room_id)
+    if feed is None or feed.task.done(): feed = FEEDS[room_id] = RoomFeed(room_id, after)
+    feed.subscribers.add(sub)
+    return feed
+
+def leave_feed(feed, sub):
+    feed.subscribers.discard(sub)
+    if not feed.subscribers: feed.event.set()
+
+def handle_frame(room_id, sender_id, ip, data):
+    kind, body = data[:1], data[1:]
+    try:
+        if kind == b'S':
+            iv, ciphertext = core.unpack_frame(body, 2)
+            data = core.decode_payload('chat_send', {'room_id': room_id, 'iv': iv, 'ciphertext': ciphertext, 'sender_id': sender_id})
+            if core.rate_limited('message', ip=ip): return '发送太快'
+            core.store_messages([(data['room_id'], data['ciphertext'], data['iv'], data['sender_id'])])
+        elif kind == b'H': core.touch_room(room_id, body.decode())
+        else: return '格式错误'
+    except core.PayloadError as e: return str(e)
+    except (ValueError, UnicodeDecodeError): return '格式错误'
+
+async def socket_writer(send, sub, backlog, after):
+    if backlog is None:
+        await send({'type': 'websocket.send', 'bytes': b'G'})
+        return await send({'type': 'websocket.close', 'code': 1000})
+    if backlog:
+        after = backlog[-1]['id']
+        await send({'type': 'websocket.send', 'bytes': b'M' + core.pack_compact(backlog)})
+    while not sub.lagging:
+        update = await sub.queue.get()
+        if update is None:
+            await send({'type': 'websocket.send', 'bytes': b'G'})
+            return await send({'type': 'websocket.close', 'code': 1000})
+        msgs, data = update
+        fresh = [row for row in msgs if row['id'] > after]
+        if not fresh: continue
+        if len(fresh) < len(msgs): data = b'M' + core.pack_compact(fresh)
+        after = fresh[-1]['id']
+        await send({'type': 'websocket.send', 'bytes': data})
+    await send({'type': 'websocket.close', 'code': 1013})
+
+async def chat_socket(scope, receive, send, room_id):
+    if (await receive())['type'] != 'websocket.connect': return
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    try: after = int(args.get('after', 0))
+    except ValueError: return await send({'type': 'websocket.close', 'code': 1008})
+    headers = dict(scope['headers'])
+    ip = headers[b'x-forwarded-for'].decode('latin-1') if b'x-forwarded-for' in headers else (scope.get('client') or ('',))[0]
+    sender_id = args.get('sender_id')
+    await send({'type': 'websocket.accept'})
+    loop = asyncio.get_running_loop()
+    sub = Subscriber()
+    feed = join_feed(room_id, sub, after)
+    writer = None
+    try:
+        backlog = await loop.run_in_executor(EXECUTOR, core.fetch_messages, room_id, after)
+        writer = asyncio.ensure_future(socket_writer(send, sub, backlog, after))
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect': return
+            if message.get('bytes'):
+                error = await loop.run_in_executor(EXECUTOR, handle_frame, room_id, sender_id, ip, message['bytes'])
+                if error and not writer.done(): await send({'type': 'websocket.send', 'bytes': b'E' + error.encode()})
+    finally:
+        leave_feed(feed, sub)
+        if writer: writer.cancel()
+
+def socket_gauges():
+    yield 'websocket_subscribers', (), sum(len(feed.subscribers) for feed in list(FEEDS.values()))
+    yield 'websocket_feeds', (), len(FEEDS)
+    yield 'long_polls_waiting', (('transport', 'asgi'),), sum(len(waiters) for waiters in list(WAITERS.values())) - len(FEEDS)
+
+core.GAUGE_PROVIDERS.append(socket_gauges)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            loop = asyncio.get_running_loop()
+            core.ROOM_LISTENERS.append(lambda room_id: room_id in WAITERS and loop.call_soon_threadsafe(wake_room, room_id))
+            core.start_background()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan': return await lifespan(receive, send)
+    if scope['type'] == 'websocket':
+        match = SOCKET_PATH.match(scope['path'])
+        if match: return await chat_socket(scope, receive, send, match.group(1))
+        return await send({'type': 'websocket.close', 'code': 1008})
+    if scope['type'] != 'http': return
+    match = POLL_PATH.match(scope['path'])
+    if match and scope['method'] == 'GET' and b'wait=' in scope['query_string']: scope = await long_poll(scope, match.group(1))
+    await bridge(scope, receive, send)
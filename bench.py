@@ -0,0 +1,605 @@
+import argparse
+import asyncio
+import base64
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ADMIN_CODE = 'bench-admin'
+POLL_INTERVAL = 1.5
+POLL_WAIT = 25
+IP_SEQ = itertools.count(1)
+BINARY_MIME = 'application/octet-stream'
+ASSET_PATH = re.compile(r'/assets/[\w.-]+')
+PAGE_VIEWS = (('identity', 'identity'), ('gzip', 'gzip'), ('br', 'br, gzip'))
+
+def fake_ip():
+    n = next(IP_SEQ)
+    return f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}'
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.ip = fake_ip()
+        self.conn = None
+        self.headers = {}
+        self.ttfb = 0
+
+    def request(self, method, path, body=None, headers=None, ip=None):
+        headers = dict(headers or {}, **{'X-Forwarded-For': ip or self.ip})
+        if isinstance(body, (dict, list)): body, headers['Content-Type'] = json.dumps(body), 'application/json'
+        for attempt in (0, 1):
+            if self.conn is None: self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            try:
+                started = time.perf_counter()
+                self.conn.request(method, path, body, headers)
+                resp = self.conn.getresponse()
+                self.ttfb = time.perf_counter() - started
+                self.headers = resp.headers
+                return resp.status, resp.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt: raise
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.sizes = {}
+
+    def add(self, op, seconds):
+        with self.lock: self.samples.setdefault(op, []).append(seconds)
+
+    def size(self, op, count):
+        with self.lock: self.sizes.setdefault(op, []).append(count)
+
+    def error(self, op, status):
+        with self.lock: self.errors[f'{op}:{status}'] = self.errors.get(f'{op}:{status}', 0) + 1
+
+    def call(self, op, client, method, path, body=None, headers=None, expect=(200,), ip=None):
+        started = time.perf_counter()
+        try: status, data = client.request(method, path, body, headers, ip)
+        except OSError: status, data = 'conn', b''
+        self.add(op, time.perf_counter() - started)
+        if status not in expect: self.error(op, status)
+        return status, data
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(values):
+    values = sorted(values)
+    ms = lambda v: round(v * 1000, 3)
+    return {'count': len(values), 'mean_ms': ms(sum(values) / len(values)), 'p50_ms': ms(percentile(values, 0.5)), 'p95_ms': ms(percentile(values, 0.95)), 'p99_ms': ms(percentile(values, 0.99)), 'max_ms': ms(values[-1])}
+
+def run_threads(count, target, *args):
+    threads = [threading.Thread(target=target, args=(i, *args), daemon=True) for i in range(count)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+def closed_loop(step):
+    def scenario(ctx):
+        def worker(i):
+            client = Client(ctx.port)
+            while time.monotonic() < ctx.deadline: step(ctx, client)
+        run_threads(ctx.args.concurrency, worker)
+    return scenario
+
+def note_body(ctx, burn_mode):
+    return {'ciphertext': b64(os.urandom(ctx.args.note_bytes)), 'iv': b64(os.urandom(12)), 'salt': None, 'expire_hours': 1, 'burn_mode': burn_mode}
+
+def note_burn(ctx, client):
+    status, data = ctx.rec.call('create', client, 'POST', '/api/note/create', note_body(ctx, 1))
+    if status == 200: ctx.rec.call('read', client, 'POST', '/api/note/read/' + json.loads(data)['id'])
+
+def note_timed(ctx, client):
+    status, data = ctx.rec.call('create', client, 'POST', '/api/note/create', note_body(ctx, 0))
+    if status != 200: return
+    for _ in range(3): ctx.rec.call('read', client, 'POST', f'/api/note/read/{json.loads(data)["id"]}?burn=0')
+
+def temp_room(ctx, client):
+    status, data = ctx.rec.call('create', client, 'POST', '/api/room/create_temp', ip=fake_ip())
+    if status != 200: return
+    room = json.loads(data)
+    for _ in range(3): ctx.rec.call('heartbeat', client, 'POST', '/api/room/heartbeat', {'room_id': room['id'], 'owner_token': room['owner_token']})
+
+def room_list(ctx, client):
+    ctx.rec.call('list', client, 'GET', '/api/rooms')
+
+def create_public_rooms(ctx, count):
+    client = Client(ctx.port)
+    rooms = []
+    for i in range(count):
+        status, data = client.request('POST', '/api/room/create_public', {'admin_code': ADMIN_CODE, 'name': f'bench-{i}', 'salt': b64(os.urandom(16))}, ip=fake_ip())
+        if status != 200: raise RuntimeError(f'create_public failed: {status} {data[:200]!r}')
+        rooms.append(json.loads(data)['id'])
+    return rooms
+
+def setup_room_list(ctx):
+    create_public_rooms(ctx, ctx.args.public_rooms)
+
+def read_compact(data):
+    (count,), pos, senders = struct.unpack_from('>H', data), 2, []
+    for _ in range(count):
+        (size,) = struct.unpack_from('>I', data, pos)
+        senders.append(data[pos + 4:pos + 4 + size])
+        pos += 4 + size
+    msgs = []
+    while pos < len(data):
+        msg_id, created_at, _ = struct.unpack_from('>QdH', data, pos)
+        pos += 18
+        parts = []
+        for _ in range(2):
+            (size,) = struct.unpack_from('>I', data, pos)
+            parts.append(data[pos + 4:pos + 4 + size])
+            pos += 4 + size
+        msgs.append((msg_id, parts[1]))
+    return msgs
+
+def poll_delay(status, headers):
+    if status == 503: return float(headers.get('Retry-After') or POLL_INTERVAL)
+    delay = headers.get('X-Poll-Delay')
+    return POLL_INTERVAL if delay is None else int(delay) / 1000
+
+def setup_chat_rooms(ctx):
+    ctx.rooms = create_public_rooms(ctx, ctx.args.chat_rooms)
+    client = Client(ctx.port)
+    for i, room in enumerate(ctx.rooms):
+        body = {'room_id': room, 'ciphertext': b64(os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': f'bench-{i}'}
+        status, data = client.request('POST', '/api/chat/send', body, ip=fake_ip())
+        if status != 200: raise RuntimeError(f'send failed: {status} {data[:200]!r}')
+
+def poll_chat(ctx, client):
+    ctx.rec.call('poll', client, 'GET', f'/api/chat/poll/{random.choice(ctx.rooms)}?last=0')
+
+def send_chat(ctx, client):
+    body = {'room_id': random.choice(ctx.rooms), 'ciphertext': b64(os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': 'bench'}
+    ctx.rec.call('send', client, 'POST', '/api/chat/send', body, ip=fake_ip())
+
+def setup_page_view(ctx):
+    status, data = Client(ctx.port).request('GET', '/', headers={'Accept-Encoding': 'identity'})
+    if status != 200: raise RuntimeError(f'shell failed: {status}')
+    ctx.assets = ASSET_PATH.findall(data.decode())
+
+def page_view(ctx, client):
+    etags = {}
+    for view, encoding in PAGE_VIEWS:
+        started, size = time.perf_counter(), 0
+        for path in ('/', *ctx.assets):
+            status, data = ctx.rec.call(view + '_get', client, 'GET', path, headers={'Accept-Encoding': encoding})
+            if path == '/': ctx.rec.add(view + '_ttfb', client.ttfb)
+            etags.setdefault(path, client.headers.get('ETag'))
+            size += len(data) + len(client.headers.as_bytes())
+        ctx.rec.add(view, time.perf_counter() - started)
+        ctx.rec.size(view, size)
+    status, data = ctx.rec.call('repeat_get', client, 'GET', '/', headers={'Accept-Encoding': 'identity', 'If-None-Match': etags['/']}, expect=(304,))
+    ctx.rec.add('repeat_ttfb', client.ttfb)
+    ctx.rec.size('repeat', len(data) + len(client.headers.as_bytes()))
+
+def setup_poll_json(ctx):
+    ctx.rooms = create_public_rooms(ctx, 1)
+    client = Client(ctx.port)
+    for i in range(ctx.args.poll_messages):
+        body = {'room_id': ctx.rooms[0], 'ciphertext': b64(os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': f'bench-{i % 8}'}
+        status, data = client.request('POST', '/api/chat/send', body, ip=fake_ip())
+        if status != 200: raise RuntimeError(f'send failed: {status} {data[:200]!r}')
+
+def poll_json(ctx, client):
+    room = ctx.rooms[0]
+    ctx.rec.call('compact', client, 'GET', f'/api/chat/poll/{room}?after=0')
+    ctx.rec.call('full', client, 'GET', f'/api/chat/poll/{room}')
+    ctx.rec.call('binary', client, 'GET', f'/api/chat/poll/{room}?after=0', headers={'Accept': BINARY_MIME})
+
+def chat(ctx):
+    rooms = create_public_rooms(ctx, ctx.args.chat_rooms)
+    def poller(i):
+        client, room, cursor = Client(ctx.port), rooms[i % len(rooms)], 0
+        next_poll = time.monotonic() + POLL_INTERVAL * i / ctx.args.chat_clients
+        while next_poll < ctx.deadline:
+            time.sleep(max(0, next_poll - time.monotonic()))
+            status, data = ctx.rec.call('poll', client, 'GET', f'/api/chat/poll/{room}?after={cursor}', headers={'Accept': BINARY_MIME}, expect=(200, 204))
+            if status == 200:
+                for msg_id, ciphertext in read_compact(data):
+                    cursor = max(cursor, msg_id)
+                    ctx.rec.add('delivery', time.time() - struct.unpack_from('>d', ciphertext)[0])
+            next_poll += poll_delay(status, client.headers)
+    def sender(i):
+        client, room = Client(ctx.port), rooms[i]
+        next_send = time.monotonic() + i / ctx.args.chat_rooms / ctx.args.send_rate
+        while next_send < ctx.deadline - POLL_INTERVAL:
+            time.sleep(max(0, next_send - time.monotonic()))
+            body = {'room_id': room, 'ciphertext': b64(struct.pack('>d', time.time()) + os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': f'bench-{i}'}
+            ctx.rec.call('send', client, 'POST', '/api/chat/send', body, ip=fake_ip())
+            next_send += 1 / ctx.args.send_rate
+    threads = [threading.Thread(target=sender, args=(i,), daemon=True) for i in range(len(rooms))]
+    for thread in threads: thread.start()
+    run_threads(ctx.args.chat_clients, poller)
+    for thread in threads: thread.join()
+
+def ws_fanout(ctx):
+    if ctx.args.server != 'asgi': raise RuntimeError('ws_fanout needs --server asgi')
+    import websockets
+    room = create_public_rooms(ctx, 1)[0]
+    url = f'ws://127.0.0.1:{ctx.port}/api/chat/ws/{room}'
+    connected = []
+    async def subscriber():
+        started = time.perf_counter()
+        try:
+            async with websockets.connect(url, extra_headers={'X-Forwarded-For': fake_ip()}, open_timeout=60, ping_interval=None, max_queue=None) as ws:
+                ctx.rec.add('connect', time.perf_counter() - started)
+                connected.append(ws)
+                async for data in ws:
+                    if data[:1] != b'M': continue
+                    now = time.time()
+                    for _, ciphertext in read_compact(data[1:]): ctx.rec.add('delivery', now - struct.unpack_from('>d', ciphertext)[0])
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e: ctx.rec.error('connect', type(e).__name__)
+    async def run():
+        loop = asyncio.get_running_loop()
+        subs = [asyncio.ensure_future(subscriber()) for _ in range(ctx.args.fanout_subscribers)]
+        while len(connected) < ctx.args.fanout_subscribers and not all(sub.done() for sub in subs) and time.monotonic() < ctx.deadline: await asyncio.sleep(0.1)
+        client = Client(ctx.port)
+        next_send = time.monotonic()
+        while next_send < ctx.deadline - 1:
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+            body = {'room_id': room, 'ciphertext': b64(struct.pack('>d', time.time()) + os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': 'bench'}
+            await loop.run_in_executor(None, lambda: ctx.rec.call('send', client, 'POST', '/api/chat/send', body, ip=fake_ip()))
+            next_send += 1 / ctx.args.send_rate
+        await asyncio.sleep(1)
+        for sub in subs: sub.cancel()
+        await asyncio.gather(*subs, return_exceptions=True)
+    asyncio.run(run())
+
+def send_burst(ctx):
+    rooms = create_public_rooms(ctx, ctx.args.chat_rooms)
+    start, sent = threading.Barrier(ctx.args.burst_senders), [0] * ctx.args.burst_senders
+    def sender(i):
+        client, room = Client(ctx.port), rooms[i % len(rooms)]
+        start.wait()
+        while time.monotonic() < ctx.deadline:
+            body = {'room_id': room, 'ciphertext': b64(os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': f'bench-{i}'}
+            if ctx.rec.call('send', client, 'POST', '/api/chat/send', body, ip=fake_ip())[0] == 200: sent[i] += 1
+    started = time.monotonic()
+    run_threads(ctx.args.burst_senders, sender)
+    ctx.summary = {'sent': sum(sent), 'sent_rps': round(sum(sent) / (time.monotonic() - started), 1)}
+
+async def http_get(reader, writer, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\nX-Forwarded-For: {fake_ip()}\r\n\r\n'.encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = re.search(rb'(?i)\r\ncontent-length: *(\d+)', head)
+    if length: await reader.readexactly(int(length.group(1)))
+    return int(head.split(None, 2)[1])
+
+def idle_connections(ctx):
+    room = create_public_rooms(ctx, 1)[0]
+    args, stop, steps = ctx.args, asyncio.Event(), []
+    async def parked():
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', ctx.port)
+            while not stop.is_set():
+                status = await http_get(reader, writer, f'/api/chat/poll/{room}?after=0&wait={POLL_WAIT}')
+                if status not in (200, 204): ctx.rec.error('park', status)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e: ctx.rec.error('park', type(e).__name__)
+    async def probe():
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', ctx.port), args.idle_probe_ms / 1000)
+            try: status = await asyncio.wait_for(http_get(reader, writer, f'/api/chat/poll/{room}?after=0'), args.idle_probe_ms / 1000)
+            finally: writer.close()
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e: status = type(e).__name__
+        ctx.rec.add('probe', time.perf_counter() - started)
+        if status not in (200, 204): ctx.rec.error('probe', status)
+        return status in (200, 204)
+    async def run():
+        tasks = []
+        for per_worker in range(args.idle_step, args.idle_max + 1, args.idle_step):
+            errors = sum(ctx.rec.errors.values())
+            tasks += [asyncio.ensure_future(parked()) for _ in range(per_worker * args.workers - len(tasks))]
+            await asyncio.sleep(1)
+            started, ok = len(ctx.rec.samples.get('probe', ())), all([await probe() for _ in range(5)])
+            ok = ok and sum(ctx.rec.errors.values()) == errors
+            probes = sorted(ctx.rec.samples['probe'][started:])
+            steps.append({'per_worker': per_worker, 'parked': len(tasks), 'probe_p99_ms': round(probes[-1] * 1000, 3), 'ok': ok})
+            print(f'  {len(tasks)} parked: probe max {steps[-1]["probe_p99_ms"]}ms{"" if ok else " FAILED"}', file=sys.stderr)
+            if not ok: break
+        stop.set()
+        await asyncio.get_running_loop().run_in_executor(None, lambda: Client(ctx.port).request('POST', '/api/chat/send', {'room_id': room, 'ciphertext': b64(os.urandom(16)), 'iv': b64(os.urandom(12)), 'sender_id': 'bench'}, ip=fake_ip()))
+        _, pending = await asyncio.wait(tasks, timeout=POLL_WAIT + 5)
+        for task in pending: task.cancel()
+    asyncio.run(run())
+    held = [step['per_worker'] for step in steps if step['ok']]
+    ctx.summary = {'idle_ceiling_per_worker': held[-1] if held else 0, 'idle_steps': steps}
+
+def contention(ctx):
+    rooms = create_public_rooms(ctx, ctx.args.chat_rooms)
+    def chat_writer(i):
+        client, room = Client(ctx.port), rooms[i % len(rooms)]
+        while time.monotonic() < ctx.deadline:
+            body = {'room_id': room, 'ciphertext': b64(os.urandom(ctx.args.message_bytes)), 'iv': b64(os.urandom(12)), 'sender_id': f'bench-{i}'}
+            ctx.rec.call('send', client, 'POST', '/api/chat/send', body, ip=fake_ip())
+    def note_writer(i):
+        client = Client(ctx.port)
+        while time.monotonic() < ctx.deadline: note_burn(ctx, client)
+    threads = [threading.Thread(target=chat_writer, args=(i,), daemon=True) for i in range(ctx.args.concurrency)]
+    for thread in threads: thread.start()
+    run_threads(ctx.args.concurrency, note_writer)
+    for thread in threads: thread.join()
+
+def churn(args, workdir):
+    import app as core
+    rng = random.Random(args.seed)
+    conn = core.get_db()
+    pool = ThreadPoolExecutor(16)
+    rec = Recorder()
+    def timed(op, fn, *fargs):
+        started = time.perf_counter()
+        result = fn(*fargs)
+        rec.add(op, time.perf_counter() - started)
+        return result
+    start = time.time()
+    rooms = [f'public-{i}' for i in range(args.chat_rooms)]
+    for room_id in rooms: core.STORE.create_room({'id': room_id, 'name': room_id, 'is_public': 1, 'salt': b'', 'created_at': start, 'owner_token': None, 'last_active': start})
+    pending_burns, hours, writes = [], [], 0
+    for minute in range(int(args.churn_hours * 60)):
+        now = start + minute * 60
+        def create_note(i):
+            uid = os.urandom(16).hex()
+            burn = rng.random() < 0.5
+            core.STORE.create_note(uid, os.urandom(rng.randint(64, args.note_bytes * 4)), os.urandom(12), None, int(now) + rng.choice((1, 1, 6)) * 3600, int(burn))
+            return uid if burn else None
+        burns = [uid for uid in timed('notes', lambda: list(pool.map(create_note, range(args.churn_notes)))) if uid]
+        timed('burn_reads', lambda: list(pool.map(lambda uid: core.STORE.take_note(uid, int(now)), pending_burns)))
+        pending_burns = [uid for uid in burns if rng.random() < 0.8]
+        msgs = [(rng.choice(rooms), os.urandom(args.message_bytes), os.urandom(12), now + i * 60 / args.churn_messages, 'bench') for i in range(args.churn_messages)]
+        temp_msgs = []
+        for _ in range(args.churn_temp_rooms):
+            room_id = os.urandom(16).hex()
+            core.EPHEMERAL.create_room({'id': room_id, 'name': '临时房间', 'is_public': 0, 'salt': '', 'created_at': now, 'owner_token': room_id, 'last_active': now})
+            temp_msgs += [(room_id, os.urandom(args.message_bytes), os.urandom(12), now, 'bench') for _ in range(10)]
+        timed('messages', core.STORE.add_messages, msgs)
+        timed('messages', core.EPHEMERAL.add_messages, temp_msgs)
+        for task in ('secrets', 'chat_messages', 'rooms'): timed('sweep', core.sweep_task, conn, task, now)
+        if minute % 5 == 4:
+            for task in core.MAINTENANCE_TASKS: timed(task, core.maintain_storage, conn, task)
+        writes += args.churn_notes + len(pending_burns) + len(msgs) + len(temp_msgs) + args.churn_temp_rooms
+        if minute % 60 == 59:
+            reports = core.storage_report().values()
+            report = {key: sum(db[key] for db in reports) for key in ('db_bytes', 'wal_bytes', 'free_pages')}
+            report['hour'] = minute // 60 + 1
+            report['live_notes'] = conn.execute('SELECT count(*) FROM secrets').fetchone()[0]
+            report['live_messages'] = sum(db.conn().execute('SELECT count(*) FROM chat_messages').fetchone()[0] for db in core.DATABASES.values() if 'chat_messages' in db.tables)
+            hours.append(report)
+            print(f"  hour {report['hour']:>3}: db {report['db_bytes']:>10}  wal {report['wal_bytes']:>9}  free pages {report['free_pages']:>6}  notes {report['live_notes']:>6}  messages {report['live_messages']}", file=sys.stderr)
+    total = lambda report: report['db_bytes'] + report['wal_bytes']
+    warm, late = hours[len(hours) // 4:len(hours) // 2], hours[len(hours) // 2:]
+    bound = max(map(total, warm)) * 1.15 if warm else 0
+    return {'writes': writes, 'ops': {op: summarize(values) for op, values in sorted(rec.samples.items())}, 'hours': hours, 'bound_bytes': int(bound), 'peak_late_bytes': max(map(total, late)) if late else 0, 'bounded': bool(late) and max(map(total, late)) <= bound}
+
+def poll_growth(args, workdir):
+    import app as core
+    rng = random.Random(args.seed)
+    rec = Recorder()
+    now = time.time()
+    probe = 'growth-probe'
+    core.STORE.create_room({'id': probe, 'name': probe, 'is_public': 1, 'salt': b'', 'created_at': now, 'owner_token': None, 'last_active': now})
+    core.STORE.add_messages([(probe, os.urandom(args.message_bytes), os.urandom(12), now - i, 'bench') for i in range(50)])
+    rooms = [f'growth-{i}' for i in range(args.chat_rooms * 100)]
+    written, step = 50, args.growth_messages // args.growth_steps
+    while True:
+        label = f'{written // 1000}k'
+        for _ in range(args.growth_polls):
+            core.CACHE.drop(probe)
+            started = time.perf_counter()
+            core.fetch_messages(probe, 0)
+            rec.add('poll@' + label, time.perf_counter() - started)
+        values = sorted(rec.samples['poll@' + label])
+        print(f'  {written:>9} messages: poll p50 {percentile(values, 0.5) * 1000:.3f}ms  p99 {percentile(values, 0.99) * 1000:.3f}ms', file=sys.stderr)
+        if written >= args.growth_messages: break
+        for _ in range(0, step, 5000):
+            rows = [(rng.choice(rooms), os.urandom(args.message_bytes), os.urandom(12), now - rng.random() * 86400, 'bench') for _ in range(5000)]
+            core.STORE.add_messages(rows)
+            written += len(rows)
+    return {'writes': written, 'ops': {op: summarize(values) for op, values in rec.samples.items()}, 'hours': []}
+
+SCENARIOS = {
+    'note_burn': (None, closed_loop(note_burn)),
+    'note_timed': (None, closed_loop(note_timed)),
+    'temp_room': (None, closed_loop(temp_room)),
+    'room_list': (setup_room_list, closed_loop(room_list)),
+    'poll_chat': (setup_chat_rooms, closed_loop(poll_chat)),
+    'send_chat': (setup_chat_rooms, closed_loop(send_chat)),
+    'chat': (None, chat),
+    'contention': (None, contention),
+    'send_burst': (None, send_burst),
+    'ws_fanout': (None, ws_fanout),
+    'idle_connections': (None, idle_connections),
+    'poll_json': (setup_poll_json, closed_loop(poll_json)),
+    'page_view': (setup_page_view, closed_loop(page_view)),
+}
+SIMULATIONS = {'churn': churn, 'poll_growth': poll_growth}
+
+class Context:
+    def __init__(self, args, port, workdir):
+        self.args = args
+        self.port = port
+        self.workdir = workdir
+        self.rec = Recorder()
+        self.deadline = 0
+        self.rooms = []
+        self.assets = []
+        self.summary = {}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def server_env(args, workdir):
+    env = dict(os.environ, ADMIN_PASSWORD=ADMIN_CODE, DB_PATH=os.path.join(workdir, 'storage.db'), RATE_DB_PATH=os.path.join(workdir, 'ratelimit.db'), ATTACHMENT_DIR=os.path.join(workdir, 'attachments'),
+               BUS_DIR=os.path.join(workdir, 'bus'), METRICS_DIR=os.path.join(workdir, 'metrics'), PROFILE_DIR=os.path.join(workdir, 'profiles'))
+    env.update(item.split('=', 1) for item in args.env)
+    return env
+
+def start_server(args, workdir):
+    port = free_port()
+    env = server_env(args, workdir)
+    cmd = [sys.executable, '-m', 'gunicorn', '--chdir', args.app_dir, '-w', str(args.workers), '-b', f'127.0.0.1:{port}', '--timeout', '60', '--log-level', 'warning']
+    cmd += ['-k', 'uvicorn.workers.UvicornWorker', 'asgi:app'] if args.server == 'asgi' else ['-k', 'gthread', '--threads', str(args.threads), 'app:app']
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None: break
+        try:
+            if Client(port).request('GET', '/api/rooms')[0] == 200: return proc, port
+        except OSError: time.sleep(0.2)
+    proc.kill()
+    with open(os.path.join(workdir, 'server.log'), 'rb') as f: sys.exit('server failed to start:\n' + f.read().decode(errors='replace'))
+
+def db_sizes(workdir):
+    files = [entry for entry in os.scandir(workdir) if entry.name.startswith('storage')]
+    return {'db_bytes': sum(entry.stat().st_size for entry in files if entry.name.endswith('.db')), 'wal_bytes': sum(entry.stat().st_size for entry in files if entry.name.endswith('.db-wal'))}
+
+def run_simulation(name, args, workdir):
+    started = time.monotonic()
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--simulate', name, '--workdir', workdir, *sys.argv[1:]], cwd=workdir, env=server_env(args, workdir), stdout=subprocess.PIPE, check=True)
+    result = json.loads(proc.stdout)
+    elapsed = time.monotonic() - started
+    final = result['hours'][-1] if result['hours'] else db_sizes(workdir)
+    return dict(result, duration_s=round(elapsed, 3), requests=result['writes'], throughput_rps=round(result['writes'] / elapsed, 1), errors={}, storage={'before': {'db_bytes': 0, 'wal_bytes': 0}, 'after': {'db_bytes': final['db_bytes'], 'wal_bytes': final['wal_bytes']}, 'growth_bytes': final['db_bytes'] + final['wal_bytes']})
+
+def run_scenario(name, args, port, workdir):
+    ctx = Context(args, port, workdir)
+    setup, scenario = SCENARIOS[name]
+    if setup: setup(ctx)
+    before = db_sizes(workdir)
+    started = time.monotonic()
+    ctx.deadline = started + args.duration
+    scenario(ctx)
+    elapsed = time.monotonic() - started
+    after = db_sizes(workdir)
+    requests = sum(len(values) for op, values in ctx.rec.samples.items() if op != 'delivery' and not op.endswith('_ttfb') and op not in ctx.rec.sizes)
+    return {
+        'duration_s': round(elapsed, 3),
+        'requests': requests,
+        'throughput_rps': round(requests / elapsed, 1),
+        'errors': ctx.rec.errors,
+        'ops': {op: summarize(values) for op, values in sorted(ctx.rec.samples.items())},
+        'bytes': {op: round(sum(values) / len(values)) for op, values in sorted(ctx.rec.sizes.items())},
+        'storage': {'before': before, 'after': after, 'growth_bytes': after['db_bytes'] + after['wal_bytes'] - before['db_bytes'] - before['wal_bytes']},
+        **ctx.summary,
+    }
+
+def git_revision(path):
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path, capture_output=True, text=True).stdout.strip())
+        return sha + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError): return 'unknown'
+
+def print_report(results, baseline=None):
+    for name, res in results['scenarios'].items():
+        old = (baseline or {}).get('scenarios', {}).get(name)
+        delta = lambda new, prev: f' ({(new - prev) / prev * 100:+.1f}%)' if prev else ''
+        print(f'\n{name}: {res["throughput_rps"]} req/s{delta(res["throughput_rps"], old and old["throughput_rps"])}, db +{res["storage"]["growth_bytes"]} bytes, errors {res["errors"] or 0}')
+        if 'sent_rps' in res: print(f'  committed {res["sent"]} sends, {res["sent_rps"]} sends/s')
+        if 'idle_ceiling_per_worker' in res: print(f'  idle ceiling {">= " if res["idle_steps"][-1]["ok"] else ""}{res["idle_ceiling_per_worker"]} parked polls per worker ({res["idle_ceiling_per_worker"] * results["meta"]["args"]["workers"]} total)')
+        if 'bounded' in res: print(f'  storage {"bounded" if res["bounded"] else "NOT bounded"}: late peak {res["peak_late_bytes"]} bytes, bound {res["bound_bytes"]} bytes')
+        for op, stats in res['ops'].items():
+            prev = old and old['ops'].get(op)
+            print(f'  {op:<14} n={stats["count"]:<7} ' + '  '.join(f'{key[:-3]}={stats[key]}ms{delta(stats[key], prev and prev[key])}' for key in ('p50_ms', 'p95_ms', 'p99_ms')))
+        for op, size in res.get('bytes', {}).items():
+            prev = old and old.get('bytes', {}).get(op)
+            print(f'  {op:<14} {size} bytes/view{delta(size, prev)}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the real endpoints of a local gunicorn server and record latency percentiles.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated: ' + ', '.join([*SCENARIOS, *SIMULATIONS]))
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads for closed-loop scenarios (contention runs this many note and chat writers each)')
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--note-bytes', type=int, default=512)
+    parser.add_argument('--public-rooms', type=int, default=200)
+    parser.add_argument('--chat-rooms', type=int, default=10)
+    parser.add_argument('--chat-clients', type=int, default=100, help='pollers spread over the chat rooms, each waiting X-Poll-Delay between polls')
+    parser.add_argument('--burst-senders', type=int, default=500, help='concurrent senders released together by the send_burst scenario')
+    parser.add_argument('--fanout-subscribers', type=int, default=1000, help='websocket subscribers in the one room of the ws_fanout scenario')
+    parser.add_argument('--idle-step', type=int, default=16, help='parked polls added per worker at each idle_connections step')
+    parser.add_argument('--idle-max', type=int, default=1024, help='parked polls per worker the idle_connections ramp stops at')
+    parser.add_argument('--idle-probe-ms', type=float, default=1000, help='probe poll latency above which the idle_connections ramp stops')
+    parser.add_argument('--send-rate', type=float, default=1.0, help='messages per second per chat room')
+    parser.add_argument('--message-bytes', type=int, default=200)
+    parser.add_argument('--poll-messages', type=int, default=200, help='messages in the room polled by the poll_json scenario')
+    parser.add_argument('--churn-hours', type=float, default=24, help='simulated hours for the churn scenario')
+    parser.add_argument('--churn-notes', type=int, default=20, help='notes created per simulated minute')
+    parser.add_argument('--churn-messages', type=int, default=300, help='public-room messages per simulated minute')
+    parser.add_argument('--churn-temp-rooms', type=int, default=2, help='temp rooms (10 messages each) per simulated minute')
+    parser.add_argument('--growth-messages', type=int, default=1000000, help='chat_messages rows the poll_growth scenario grows the table to')
+    parser.add_argument('--growth-steps', type=int, default=10, help='poll latency samples taken while poll_growth fills the table')
+    parser.add_argument('--growth-polls', type=int, default=200, help='uncached polls of the probe room per poll_growth step')
+    parser.add_argument('--app-dir', default=ROOT, help='checkout to serve, e.g. a git worktree of an older revision')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra environment for the server')
+    parser.add_argument('--out', help='result file (default bench-results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='earlier result file to diff against')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary data directory')
+    parser.add_argument('--simulate', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.simulate:
+        sys.path.insert(0, args.app_dir)
+        return print(json.dumps(SIMULATIONS[args.simulate](args, args.workdir)))
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in SCENARIOS and name not in SIMULATIONS]
+    if unknown: parser.error('unknown scenario: ' + ', '.join(unknown))
+    revision = git_revision(args.app_dir)
+    results = {'meta': {'revision': revision, 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(), 'sqlite': __import__('sqlite3').sqlite_version, 'platform': platform.platform(), 'cpus': os.cpu_count(), 'args': vars(args)}, 'scenarios': {}}
+    for name in names:
+        workdir = tempfile.mkdtemp(prefix='secret-note-bench-')
+        proc = None
+        try:
+            if name in SIMULATIONS:
+                print(f'simulating {name} for {args.churn_hours}h ...', file=sys.stderr)
+                results['scenarios'][name] = run_simulation(name, args, workdir)
+            else:
+                proc, port = start_server(args, workdir)
+                print(f'running {name} for {args.duration}s ...', file=sys.stderr)
+                results['scenarios'][name] = run_scenario(name, args, port, workdir)
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait(30)
+            if args.keep: print(f'kept {workdir}', file=sys.stderr)
+            else: shutil.rmtree(workdir, ignore_errors=True)
+    out = args.out or os.path.join(ROOT, 'bench-results', f'{time.strftime("%Y%m%d-%H%M%S")}-{revision}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f: json.dump(results, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+    print_report(results, baseline)
+    print(f'\nsaved {out}')
+
+if __name__ == '__main__':
+    main()
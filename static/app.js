@@ -0,0 +1,416 @@
+const myClientId = Math.random().toString(36).substring(2);
+const path = window.location.pathname;
+const FILE_MARK = '\u0001file:';
+const FILE_CHUNK = 64 * 1024;
+
+window.loadMedia = function(el, url, type) {
+    if (type === 'img') {
+        el.outerHTML = '<img src="' + url + '">';
+    } else if (type === 'video') {
+        el.outerHTML = '<video controls src="' + url + '"></video>';
+    }
+};
+
+async function getKey(password, salt) {
+    const enc = new TextEncoder();
+    const keyMaterial = await window.crypto.subtle.importKey("raw", enc.encode(password), "PBKDF2", false, ["deriveKey"]);
+    return window.crypto.subtle.deriveKey({ name: "PBKDF2", salt: salt, iterations: 100000, hash: "SHA-256" }, keyMaterial, { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
+}
+async function encryptData(text, key) {
+    const iv = window.crypto.getRandomValues(new Uint8Array(12));
+    const encoded = new TextEncoder().encode(text);
+    const encrypted = await window.crypto.subtle.encrypt({ name: "AES-GCM", iv: iv }, key, encoded);
+    return { ciphertext: new Uint8Array(encrypted), iv: iv };
+}
+async function decryptData(ciphertext, iv, key) {
+    const decrypted = await window.crypto.subtle.decrypt({ name: "AES-GCM", iv: iv }, key, ciphertext);
+    return new TextDecoder().decode(decrypted);
+}
+function packFrame(...parts) {
+    const out = new Uint8Array(parts.reduce((n, p) => n + 4 + p.byteLength, 0));
+    const view = new DataView(out.buffer);
+    let pos = 0;
+    for (const p of parts) { view.setUint32(pos, p.byteLength); out.set(p, pos + 4); pos += 4 + p.byteLength; }
+    return out;
+}
+function unpackFrame(bytes, pos, count) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const parts = [];
+    for (let i = 0; i < count; i++) { const n = view.getUint32(pos); parts.push(bytes.subarray(pos + 4, pos + 4 + n)); pos += 4 + n; }
+    return [parts, pos];
+}
+function framesReady(bytes, pos, count) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    for (let i = 0; i < count; i++) { if (pos + 4 > bytes.byteLength) return false; pos += 4 + view.getUint32(pos); }
+    return pos <= bytes.byteLength;
+}
+function chunkAad(index, last) {
+    const aad = new Uint8Array(5);
+    new DataView(aad.buffer).setUint32(0, index); aad[4] = last ? 1 : 0;
+    return aad;
+}
+async function uploadFile(file, key, query) {
+    if (!file.size) throw new Error('文件为空');
+    const total = Math.ceil(file.size / FILE_CHUNK), parts = [];
+    for (let i = 0; i < total; i++) {
+        const iv = window.crypto.getRandomValues(new Uint8Array(12));
+        const plain = await file.slice(i * FILE_CHUNK, (i + 1) * FILE_CHUNK).arrayBuffer();
+        parts.push(packFrame(iv, new Uint8Array(await window.crypto.subtle.encrypt({ name: "AES-GCM", iv: iv, additionalData: chunkAad(i, i === total - 1) }, key, plain))));
+    }
+    const resp = await fetch('/api/file/upload?' + query, { method: 'POST', headers: {'Content-Type': 'application/octet-stream'}, body: new Blob(parts) });
+    const data = await resp.json();
+    if (data.error) throw new Error(data.error);
+    return FILE_MARK + JSON.stringify({ id: data.id, name: file.name, size: file.size });
+}
+async function downloadFile(ref, key, burn) {
+    const resp = await fetch('/api/file/read/' + ref.id + (burn ? '' : '?burn=0'), { method: 'POST' });
+    if (!resp.ok) throw new Error('文件不存在或已销毁');
+    const total = Math.ceil(ref.size / FILE_CHUNK), reader = resp.body.getReader(), plain = [];
+    let pending = new Uint8Array(0), done = false;
+    while (!done) {
+        const chunk = await reader.read();
+        done = chunk.done;
+        if (chunk.value) { const merged = new Uint8Array(pending.byteLength + chunk.value.byteLength); merged.set(pending); merged.set(chunk.value, pending.byteLength); pending = merged; }
+        let pos = 0, parts;
+        while (framesReady(pending, pos, 2)) {
+            [parts, pos] = unpackFrame(pending, pos, 2);
+            const i = plain.length;
+            plain.push(await window.crypto.subtle.decrypt({ name: "AES-GCM", iv: parts[0], additionalData: chunkAad(i, i === total - 1) }, key, parts[1]));
+        }
+        pending = pending.slice(pos);
+    }
+    if (pending.byteLength || plain.length !== total) throw new Error('文件不完整');
+    const link = document.createElement('a');
+    link.href = URL.createObjectURL(new Blob(plain)); link.download = ref.name; link.click();
+    setTimeout(() => URL.revokeObjectURL(link.href), 60000);
+}
+function formatSize(size) { return size < 1048576 ? (size / 1024).toFixed(1) + ' KB' : (size / 1048576).toFixed(1) + ' MB'; }
+function arrayBufferToBase64(buffer) {
+    let binary = '';
+    const bytes = new Uint8Array(buffer);
+    for (let i = 0; i < bytes.byteLength; i++) binary += String.fromCharCode(bytes[i]);
+    return window.btoa(binary);
+}
+function base64ToArrayBuffer(base64) {
+    const binary_string = window.atob(base64);
+    const len = binary_string.length;
+    const bytes = new Uint8Array(len);
+    for (let i = 0; i < len; i++) bytes[i] = binary_string.charCodeAt(i);
+    return bytes.buffer;
+}
+
+window.onload = function() {
+    if (path.startsWith('/note/')) {
+        document.getElementById('home-view').classList.add('hidden');
+        document.getElementById('note-wrapper').classList.remove('hidden');
+        document.getElementById('create-view').classList.add('hidden');
+        document.getElementById('decrypt-view').classList.remove('hidden');
+        initNoteView();
+    } else if (path.startsWith('/chat/')) {
+        document.getElementById('home-view').classList.add('hidden');
+        document.getElementById('chat-view').classList.remove('hidden');
+        initChat();
+    } else { loadRooms(); }
+};
+
+async function createTempRoom() {
+    const key = await window.crypto.subtle.generateKey({ name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
+    const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
+    const resp = await fetch('/api/room/create_temp', { method: 'POST' });
+    const data = await resp.json();
+    if(data.error) return alert(data.error);
+    sessionStorage.setItem('owner_token_' + data.id, data.owner_token);
+    window.location.href = '/chat/' + data.id + '#' + JSON.stringify(exportedKey);
+}
+
+let chatKey = null, lastMsgId = 0, chatRoomId = null, heartbeatInterval = null, chatSocket = null;
+
+async function initChat() {
+    chatRoomId = path.split('/').pop();
+    const ownerToken = sessionStorage.getItem('owner_token_' + chatRoomId);
+    if (ownerToken) {
+        document.getElementById('copy-link-btn').style.display = 'block'; 
+        heartbeatInterval = setInterval(() => {
+            if (chatSocket) chatSocket.send(withKind('H', new TextEncoder().encode(ownerToken)));
+            else fetch('/api/room/heartbeat', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: chatRoomId, owner_token: ownerToken }) });
+        }, 3000);
+    }
+    if (!window.location.hash) {
+        const pass = prompt("请输入密码:");
+        if(pass) {
+            const resp = await fetch('/api/room/info/' + chatRoomId);
+            const data = await resp.json();
+            if(data.error) { alert('房间已销毁'); window.location.href='/'; return; }
+            chatKey = await getKey(pass, base64ToArrayBuffer(data.salt));
+        } else { return appendChatMsg("缺少密钥", "system-msg"); }
+    } else {
+        try {
+            const jwk = JSON.parse(decodeURIComponent(window.location.hash.substring(1)));
+            chatKey = await window.crypto.subtle.importKey("jwk", jwk, { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
+        } catch(e) { return appendChatMsg("密钥错误", "system-msg"); }
+    }
+    appendChatMsg("已连接。消息5分钟销毁。", "system-msg");
+    if(ownerToken) appendChatMsg("【房主】页面关闭后房间将销毁。", "system-msg");
+    connectSocket();
+}
+
+function withKind(kind, body) {
+    const out = new Uint8Array(1 + body.byteLength);
+    out[0] = kind.charCodeAt(0); out.set(body, 1);
+    return out;
+}
+
+function connectSocket() {
+    if (!window.WebSocket) return pollMessages();
+    const scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+    const ws = new WebSocket(`${scheme}${location.host}/api/chat/ws/${chatRoomId}?after=${lastMsgId}&sender_id=${myClientId}`);
+    ws.binaryType = 'arraybuffer';
+    let opened = false, inbox = Promise.resolve();
+    ws.onopen = () => { opened = true; chatSocket = ws; };
+    ws.onmessage = (event) => { inbox = inbox.then(async () => {
+        const bytes = new Uint8Array(event.data), kind = String.fromCharCode(bytes[0]);
+        if (kind === 'M') await showMessages(bytes.subarray(1));
+        else if (kind === 'G') { alert('房间已销毁'); window.location.href = '/'; }
+        else if (kind === 'E') alert(new TextDecoder().decode(bytes.subarray(1)));
+    }); };
+    ws.onclose = () => {
+        chatSocket = null;
+        if (opened) setTimeout(connectSocket, 1000); else pollMessages();
+    };
+}
+
+async function showMessages(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let [senders, pos] = unpackFrame(bytes, 2, view.getUint16(0)), parts;
+    senders = senders.map(s => new TextDecoder().decode(s));
+    while (pos < bytes.byteLength) {
+        const id = Number(view.getBigUint64(pos)), sender = senders[view.getUint16(pos + 16)];
+        [parts, pos] = unpackFrame(bytes, pos + 18, 2);
+        if (id <= lastMsgId) continue;
+        lastMsgId = id;
+        if (sender === myClientId) continue;
+        try { const text = await decryptData(parts[1], parts[0], chatKey); appendChatMsg(text, 'other'); } catch (e) { }
+    }
+}
+
+async function pollMessages() {
+    if (!chatRoomId || !chatKey) return;
+    try {
+        const resp = await fetch(`/api/chat/poll/${chatRoomId}?after=${lastMsgId}&wait=25`, { headers: { 'Accept': 'application/octet-stream' } });
+        if (resp.status === 410) { alert('房间已销毁'); window.location.href = '/'; return; }
+        if (resp.status === 200) await showMessages(new Uint8Array(await resp.arrayBuffer()));
+        setTimeout(pollMessages, nextDelay(resp, 1500));
+    } catch(e) { setTimeout(pollMessages, 1500); }
+}
+
+function nextDelay(resp, fallback) {
+    if (resp.status === 503) return (Number(resp.headers.get('Retry-After')) || fallback / 1000) * 1000;
+    const delay = resp.headers.get('X-Poll-Delay');
+    return delay === null ? fallback : Number(delay);
+}
+
+async function exitChat() {
+    if(confirm("确定退出吗？")) {
+        const ownerToken = sessionStorage.getItem('owner_token_' + chatRoomId);
+        if(ownerToken) {
+            await fetch('/api/room/delete', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: chatRoomId, owner_token: ownerToken }) });
+        }
+        window.location.href = '/';
+    }
+}
+
+function copyRoomLink() {
+    navigator.clipboard.writeText(window.location.href).then(() => alert('邀请链接已复制'));
+}
+
+function copyNoteLink() {
+    const link = document.getElementById('share-link').innerText;
+    navigator.clipboard.writeText(link).then(() => alert('私密链接已复制，请发送给对方。'));
+}
+
+async function sendChatMsg() {
+    const input = document.getElementById('chat-msg-input');
+    const text = input.value.trim();
+    if (!text || !chatKey) return;
+    input.value = ''; appendChatMsg(text, 'me');
+    try { await postChatText(text); } catch(e) {
+        if(e.message && e.message.includes('413')) alert('内容太长');
+        else if(e.message && e.message.includes('429')) alert('说话太快了，请慢一点');
+        else if(e.message && e.message.includes('503')) alert('服务器繁忙，请稍后再试');
+    }
+}
+
+async function postChatText(text) {
+    const result = await encryptData(text, chatKey);
+    if (chatSocket) return chatSocket.send(withKind('S', packFrame(result.iv, result.ciphertext)));
+    const resp = await fetch(`/api/chat/send?room_id=${chatRoomId}&sender_id=${myClientId}`, { method: 'POST', headers: {'Content-Type': 'application/octet-stream'}, body: packFrame(result.iv, result.ciphertext) });
+    if (!resp.ok) throw new Error(String(resp.status));
+}
+
+async function sendChatFile(input) {
+    const file = input.files[0];
+    input.value = '';
+    if (!file || !chatKey) return;
+    appendChatMsg('正在加密上传 ' + file.name + ' ...', 'system-msg');
+    try {
+        const text = await uploadFile(file, chatKey, 'room_id=' + chatRoomId);
+        appendChatMsg(text, 'me');
+        await postChatText(text);
+    } catch(e) { alert('上传失败: ' + e.message); }
+}
+
+function appendChatMsg(text, type) {
+    const box = document.getElementById('chat-box');
+    if (type === 'system-msg') {
+        const div = document.createElement('div'); div.className = 'system-msg'; div.innerText = text; box.appendChild(div);
+    } else {
+        const row = document.createElement('div'); row.className = 'msg-row ' + type;
+        const bubble = document.createElement('div'); bubble.className = 'msg-bubble';
+        if (text.startsWith(FILE_MARK)) {
+            const ref = JSON.parse(text.substring(FILE_MARK.length));
+            const btn = document.createElement('div'); btn.className = 'media-placeholder';
+            btn.innerText = `📎 ${ref.name} (${formatSize(ref.size)}) 点击下载`;
+            btn.onclick = () => downloadFile(ref, chatKey, false).catch(e => alert(e.message));
+            bubble.appendChild(btn); row.appendChild(bubble); box.appendChild(row);
+            box.scrollTop = box.scrollHeight;
+            return;
+        }
+
+        let safeText = text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
+        const urlRegex = /(https?:\/\/[^"'\s]+)/g;
+
+        const imgRegex = /(https?:\/\/[^"'\s]+\.(?:png|jpg|jpeg|gif|webp))/i;
+        const videoRegex = /(https?:\/\/[^"'\s]+\.(?:mp4|webm|ogg))/i;
+
+        if (imgRegex.test(text)) {
+            bubble.innerHTML = safeText.replace(urlRegex, '<div class="media-placeholder" onclick="window.loadMedia(this, \'$1\', \'img\')">🖼️ 点击加载图片 (隐私保护)</div>');
+        } else if (videoRegex.test(text)) {
+            bubble.innerHTML = safeText.replace(urlRegex, '<div class="media-placeholder" onclick="window.loadMedia(this, \'$1\', \'video\')">▶️ 点击播放视频 (隐私保护)</div>');
+        } else {
+            bubble.innerHTML = safeText.replace(urlRegex, '<a href="$1" target="_blank" rel="noopener noreferrer">$1</a>');
+        }
+
+        row.appendChild(bubble); box.appendChild(row);
+    }
+    box.scrollTop = box.scrollHeight;
+}
+
+async function loadRooms() {
+    try {
+        const resp = await fetch('/api/rooms');
+        if (resp.status === 503) return setTimeout(loadRooms, nextDelay(resp, 5000));
+        const rooms = await resp.json();
+        const listEl = document.getElementById('room-list');
+        listEl.innerHTML = '';
+        if (rooms.length === 0) { listEl.innerHTML = '<div style="text-align:center; color:#64748b; padding:20px;">暂无公开房间</div>'; return; }
+        rooms.forEach(room => {
+            const div = document.createElement('div'); div.className = 'room-item';
+            div.innerHTML = `<div class="room-info"><span class="room-name">${escapeHtml(room.name)}</span><span class="room-time">${new Date(room.created_at * 1000).toLocaleString()}</span></div><div style="display:flex; gap:5px;"><button class="btn btn-primary btn-sm" onclick="joinRoom('${room.id}', '${room.name}', '${room.salt}')">加入</button><button class="btn btn-danger btn-sm" style="padding:8px 10px;" onclick="deleteRoom('${room.id}')">×</button></div>`;
+            listEl.appendChild(div);
+        });
+    } catch (e) {}
+}
+async function createPublicRoom() {
+    const name = document.getElementById('new-room-name').value.trim();
+    const pass = document.getElementById('new-room-pass').value;
+    const adminCode = document.getElementById('admin-code').value;
+    if (!name || !pass || !adminCode) return alert('请填写完整');
+    const salt = window.crypto.getRandomValues(new Uint8Array(16));
+    const saltBase64 = arrayBufferToBase64(salt);
+    const key = await getKey(pass, salt);
+    const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
+    const resp = await fetch('/api/room/create_public', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ name: name, salt: saltBase64, admin_code: adminCode }) });
+    const data = await resp.json();
+    if (data.error) return alert(data.error);
+    window.location.href = '/chat/' + data.id + '#' + JSON.stringify(exportedKey);
+}
+async function joinRoom(id, name, saltBase64) {
+    const pass = prompt(`请输入房间 "${name}" 的密码:`);
+    if (!pass) return;
+    try {
+        const salt = base64ToArrayBuffer(saltBase64);
+        const key = await getKey(pass, salt);
+        const exportedKey = await window.crypto.subtle.exportKey("jwk", key);
+        window.location.href = '/chat/' + id + '#' + JSON.stringify(exportedKey);
+    } catch (e) { alert('错误'); }
+}
+async function deleteRoom(id) {
+    const code = prompt("管理员口令:");
+    if(!code) return;
+    const resp = await fetch('/api/room/delete', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ room_id: id, admin_code: code }) });
+    const data = await resp.json();
+    if(data.error) alert(data.error); else loadRooms();
+}
+
+function showCreateRoomModal() { document.getElementById('create-room-modal').classList.remove('hidden'); }
+function closeModal(id) { document.getElementById(id).classList.add('hidden'); }
+function showNoteCreate() { document.getElementById('home-view').classList.add('hidden'); document.getElementById('note-wrapper').classList.remove('hidden'); }
+function escapeHtml(text) { const div = document.createElement('div'); div.innerText = text; return div.innerHTML; }
+
+let noteMeta = null;
+
+async function initNoteView() {
+    const resp = await fetch('/api/note/meta/' + path.split('/').pop());
+    if (!resp.ok) { alert('笔记不存在或已过期'); location.href = '/'; return; }
+    noteMeta = await resp.json();
+    const isBurn = noteMeta.burn;
+    const title = document.getElementById('view-title');
+    if (isBurn) { title.innerText = "🔥 阅后即焚"; document.getElementById('view-desc').innerText = "⚠️ 注意：此笔记阅读一次后将立即销毁！"; }
+    else { title.innerText = "📅 限时笔记"; document.getElementById('view-desc').innerText = "此笔记在过期前可多次查看。"; }
+    if (noteMeta.has_pass) document.getElementById('pass-input-area').classList.remove('hidden');
+}
+async function createNote() {
+    const text = document.getElementById('content').value;
+    const file = document.getElementById('note-file').files[0];
+    if (!text && !file) return;
+    const btn = document.getElementById('create-btn'); btn.innerText = '处理中...'; btn.disabled = true;
+    try {
+        const password = document.getElementById('password').value;
+        let key, salt;
+        if (password) { salt = window.crypto.getRandomValues(new Uint8Array(16)); key = await getKey(password, salt); }
+        else { key = await window.crypto.subtle.generateKey({ name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]); salt = null; }
+        const isBurn = document.getElementById('burn-toggle').checked;
+        const query = `expire_hours=${document.getElementById('expiration').value}&burn_mode=${isBurn ? 1 : 0}`;
+        const result = await encryptData(file ? (await uploadFile(file, key, query)) + '\n' + text : text, key);
+        const exportKey = password ? null : await window.crypto.subtle.exportKey("jwk", key);
+        const resp = await fetch('/api/note/create?' + query, { method: 'POST', headers: {'Content-Type': 'application/octet-stream'}, body: packFrame(result.iv, salt || new Uint8Array(0), result.ciphertext) });
+        const data = await resp.json();
+        let link = window.location.origin + '/note/' + data.id;
+        if (!password) link += '#' + JSON.stringify(exportKey);
+        else document.getElementById('password-reminder').classList.remove('hidden');
+        document.getElementById('create-view').classList.add('hidden');
+        document.getElementById('result-view').classList.remove('hidden');
+        document.getElementById('share-link').innerText = link;
+    } catch(e) { alert('错误: ' + e); btn.disabled = false; }
+}
+async function fetchAndDecryptNote() {
+    const id = path.split('/').pop();
+    try {
+        const resp = await fetch('/api/note/read/' + id + (noteMeta.burn ? '' : '?burn=0'), { method: 'POST', headers: { 'Accept': 'application/octet-stream' } });
+        if (!resp.ok) return alert((await resp.json()).error);
+        const [[iv, salt, ciphertext]] = unpackFrame(new Uint8Array(await resp.arrayBuffer()), 0, 3);
+        const data = { ciphertext: ciphertext, iv: iv };
+        let key;
+        if (salt.byteLength) {
+            const pwd = document.getElementById('decrypt-pass').value;
+            if (!pwd) return alert('请输入密码');
+            key = await getKey(pwd, salt);
+        } else { key = await window.crypto.subtle.importKey("jwk", JSON.parse(decodeURIComponent(window.location.hash.substring(1))), { name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]); }
+        let text = await decryptData(data.ciphertext, data.iv, key);
+        if (text.startsWith(FILE_MARK)) {
+            const end = text.indexOf('\n');
+            const ref = JSON.parse(text.substring(FILE_MARK.length, end));
+            text = text.substring(end + 1);
+            const fileBtn = document.getElementById('note-file-btn');
+            fileBtn.innerText = `📎 下载附件 ${ref.name} (${formatSize(ref.size)})`;
+            fileBtn.onclick = () => downloadFile(ref, key, noteMeta.burn).catch(e => alert(e.message));
+            fileBtn.classList.remove('hidden');
+        }
+        document.getElementById('decrypt-view').classList.add('hidden');
+        document.getElementById('content-view').classList.remove('hidden');
+        document.getElementById('decrypted-content').value = text;
+        const status = document.getElementById('burn-status');
+        if (noteMeta.burn) status.innerText = "🔥 笔记已销毁，无法再次访问。";
+        else { status.innerText = "✅ 笔记暂未销毁，过期前可再次访问。"; status.style.color = "#10b981"; }
+    } catch(e) { alert('解密失败，密码错误或链接无效'); }
+}
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+WORK = tempfile.mkdtemp(prefix='secret-note-test-')
+os.environ.update(DB_PATH=os.path.join(WORK, 'storage.db'), RATE_DB_PATH=os.path.join(WORK, 'ratelimit.db'), ATTACHMENT_DIR=os.path.join(WORK, 'attachments'), BUS_DIR='', METRICS_DIR='', PROFILE_DIR='', ADMISSION='0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
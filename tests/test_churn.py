@@ -0,0 +1,38 @@
+import os
+import random
+import time
+
+import app
+
+DB_CEILING = 4 * 1024 * 1024
+FREE_PAGE_CEILING = app.VACUUM_KEEP_FREE + app.VACUUM_STEP_PAGES
+
+def test_storage_stays_bounded_over_a_day_of_churn():
+    rng = random.Random(1)
+    conn = app.get_db()
+    start = time.time()
+    rooms = [f'churn-{i}' for i in range(10)]
+    for room_id in rooms: app.STORE.create_room({'id': room_id, 'name': room_id, 'is_public': 1, 'salt': '', 'created_at': start, 'owner_token': None, 'last_active': start})
+    burns, written = [], 0
+    for step in range(96):
+        now = start + step * 900
+        for uid in burns: app.STORE.take_note(uid, int(now))
+        burns = []
+        for i in range(8):
+            uid = os.urandom(16).hex()
+            app.STORE.create_note(uid, os.urandom(rng.randint(64, 2048)), os.urandom(12), None, int(now) + 3600, i % 2)
+            if i % 4 == 1: burns.append(uid)
+        app.STORE.add_messages([(rng.choice(rooms), os.urandom(200), os.urandom(12), now + i * 900 / 1000, 'churn') for i in range(1000)])
+        for _ in range(2):
+            room_id = os.urandom(16).hex()
+            app.EPHEMERAL.create_room({'id': room_id, 'name': '临时房间', 'is_public': 0, 'salt': '', 'created_at': now, 'owner_token': room_id, 'last_active': now})
+        written += 1000 + 8
+        for task in ('secrets', 'chat_messages', 'rooms'): app.sweep_task(conn, task, now + 900)
+        for task in app.MAINTENANCE_TASKS: app.maintain_storage(conn, task)
+        if step >= 8:
+            for name, report in app.storage_report().items():
+                assert report['db_bytes'] <= DB_CEILING, (step, name, report)
+                assert report['wal_bytes'] <= app.WAL_TRUNCATE_BYTES, (step, name, report)
+                assert report['free_pages'] <= FREE_PAGE_CEILING, (step, name, report)
+    assert written * 200 > 4 * DB_CEILING
+    assert conn.execute('SELECT count(*) FROM secrets WHERE expire_at > ?', (int(start + 96 * 900),)).fetchone()[0] <= 8 * 5
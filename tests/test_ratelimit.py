@@ -0,0 +1,76 @@
+import pytest
+
+import app
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def rate_store(request, tmp_path):
+    if request.param == 'memory': return app.MemoryRateStore(100)
+    if request.param == 'sqlite': return app.SQLiteRateStore(str(tmp_path / 'ratelimit.db'), 100)
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    return app.RedisRateStore(fakeredis.FakeRedis())
+
+def test_bucket_starts_full_and_caps_at_capacity(rate_store):
+    assert all(rate_store.take('k', 5, 1, 1, 1000) for _ in range(5))
+    assert not rate_store.take('k', 5, 1, 1, 1000)
+    assert rate_store.take('k', 5, 1, 5, 2000)
+    assert not rate_store.take('k', 5, 1, 1, 2000)
+
+def test_bucket_refills_at_rate(rate_store):
+    assert rate_store.take('k', 4, 0.5, 4, 1000)
+    assert not rate_store.take('k', 4, 0.5, 1, 1001)
+    assert rate_store.take('k', 4, 0.5, 1, 1002)
+    assert not rate_store.take('k', 4, 0.5, 1, 1002)
+    assert rate_store.take('k', 4, 0.5, 2, 1006)
+    assert not rate_store.take('k', 4, 0.5, 1, 1006)
+
+def test_denied_take_keeps_tokens(rate_store):
+    assert rate_store.take('k', 3, 1, 2, 1000)
+    assert not rate_store.take('k', 3, 1, 2, 1000)
+    assert rate_store.take('k', 3, 1, 1, 1000)
+
+def test_keys_are_independent(rate_store):
+    assert rate_store.take('a', 1, 1, 1, 1000)
+    assert not rate_store.take('a', 1, 1, 1, 1000)
+    assert rate_store.take('b', 1, 1, 1, 1000)
+
+def test_memory_store_evicts_least_recently_used():
+    store = app.MemoryRateStore(2)
+    store.take('a', 1, 0.001, 1, 1000)
+    store.take('b', 1, 0.001, 1, 1001)
+    store.take('a', 1, 0.001, 1, 1002)
+    store.take('c', 1, 0.001, 1, 1003)
+    assert list(store.buckets) == ['a', 'c']
+    assert store.take('b', 1, 0.001, 1, 1004)
+    assert not store.take('c', 1, 0.001, 1, 1004)
+
+def test_memory_store_purges_idle_buckets():
+    store = app.MemoryRateStore(100)
+    store.take('a', 1, 1, 1, 1000)
+    store.take('b', 1, 1, 1, 1000 + app.RATE_IDLE)
+    store.purge(1001 + app.RATE_IDLE)
+    assert list(store.buckets) == ['b']
+
+def test_sqlite_store_purge_keeps_most_recent_keys(tmp_path):
+    store = app.SQLiteRateStore(str(tmp_path / 'ratelimit.db'), 2)
+    store.take('a', 1, 1, 1, 1000)
+    store.take('b', 1, 1, 1, 1001)
+    store.take('c', 1, 1, 1, 1002)
+    assert store.take('a', 1, 1, 1, 1003)
+    store.purge(1003)
+    assert store.size() == 2
+    assert sorted(key for key, in store.db().execute('SELECT key FROM buckets')) == ['a', 'c']
+    store.take('z', 1, 1, 1, 1000 + app.RATE_IDLE)
+    store.purge(1004 + app.RATE_IDLE)
+    assert [key for key, in store.db().execute('SELECT key FROM buckets')] == ['z']
+
+def test_redis_script_stores_bucket_with_expiry():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    client = fakeredis.FakeRedis()
+    store = app.RedisRateStore(client)
+    assert store.take('k', 10, 2, 3, 1000)
+    assert float(client.hget('rl:k', 't')) == 7
+    assert float(client.hget('rl:k', 'ts')) == 1000
+    assert client.ttl('rl:k') == 6
+    assert store.size() is None
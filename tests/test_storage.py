@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    if request.param == 'memory': return app.MemoryStorage()
+    notes = app.Database('notes', str(tmp_path / 'notes.db'), 'notes', app.MIGRATIONS)
+    rooms = app.Database('rooms', str(tmp_path / 'rooms.db'), 'chat', app.CHAT_MIGRATIONS)
+    for db in (notes, rooms): app.init_db(db)
+    return app.SQLiteStorage(notes, rooms, [rooms])
+
+def make_room(store, room_id, is_public=0, created_at=None, last_active=None):
+    now = time.time()
+    store.create_room({'id': room_id, 'name': 'room ' + room_id, 'is_public': is_public, 'salt': 'salt-' + room_id, 'created_at': created_at or now, 'owner_token': 'token-' + room_id, 'last_active': last_active or now})
+
+def test_burn_note_is_taken_once(store):
+    now = int(time.time())
+    store.create_note('n1', b'ct', b'iv', b'salt', now + 60, 1)
+    assert store.note_meta('n1', now) == {'has_pass': True, 'burn': True}
+    assert store.peek_note('n1', now) is None
+    note = store.take_note('n1', now)
+    assert (note['ciphertext'], note['iv'], note['salt']) == (b'ct', b'iv', b'salt')
+    assert store.take_note('n1', now) is None
+    assert not store.note_meta('n1', now)
+
+def test_timed_note_is_readable_until_expiry(store):
+    now = int(time.time())
+    store.create_note('n2', b'ct', b'iv', None, now + 60, 0)
+    assert store.note_meta('n2', now) == {'has_pass': False, 'burn': False}
+    assert store.take_note('n2', now) is None
+    assert store.peek_note('n2', now)['ciphertext'] == b'ct'
+    assert store.peek_note('n2', now)['ciphertext'] == b'ct'
+    assert store.peek_note('n2', now + 60) is None
+    assert not store.note_meta('n2', now + 60)
+
+def test_room_lookup_and_ownership(store):
+    make_room(store, 'r1')
+    assert store.room_salt('r1') == 'salt-r1'
+    assert store.room_salt('missing') is None
+    assert store.is_owner('r1', 'token-r1')
+    assert not store.is_owner('r1', 'token-r2')
+    assert not store.is_owner('r1', None)
+    assert not store.is_owner('missing', 'token-r1')
+
+def test_room_states_and_touch(store):
+    make_room(store, 'r1', last_active=100)
+    make_room(store, 'r2', is_public=1, last_active=100)
+    store.touch_rooms([('r1', 200), ('r2', 50), ('missing', 300)])
+    states = {row['id']: (row['is_public'], row['last_active']) for row in store.room_states(['r1', 'r2', 'missing'])}
+    assert states == {'r1': (0, 200), 'r2': (1, 100)}
+
+def test_public_rooms_newest_first(store):
+    make_room(store, 'old', is_public=1, created_at=100)
+    make_room(store, 'new', is_public=1, created_at=300)
+    make_room(store, 'temp', is_public=0, created_at=400)
+    assert [room['id'] for room in store.public_rooms(0)] == ['new', 'old']
+    assert [room['id'] for room in store.public_rooms(200)] == ['new']
+    assert set(store.public_rooms(0)[0]) == {'id', 'name', 'created_at', 'salt'}
+
+def test_messages_get_increasing_ids(store):
+    now = time.time()
+    first = store.add_messages([('r1', b'a', b'iv', now, 's1'), ('r2', b'b', b'iv', now, 's2')])
+    second = store.add_messages([('r1', b'c', b'iv', now, 's1')])
+    assert first[0] < first[1] < second[0]
+    rows = sorted(store.recent_messages(['r1'], now - 60), key=lambda row: row['id'])
+    assert [(row['id'], row['room_id'], row['ciphertext'], row['sender_id']) for row in rows] == [(first[0], 'r1', b'a', 's1'), (second[0], 'r1', b'c', 's1')]
+
+def test_recent_messages_filters_by_time(store):
+    now = time.time()
+    store.add_messages([('r1', b'old', b'iv', now - 100, 's'), ('r1', b'new', b'iv', now, 's')])
+    assert [row['ciphertext'] for row in store.recent_messages(['r1'], now - 50)] == [b'new']
+    assert store.recent_messages(['other'], 0) == []
+
+def test_add_messages_delivers_committed_entries(store):
+    now = time.time()
+    delivered = []
+    ids = store.add_messages([('r1', b'a', b'iv', now, 's'), ('r1', b'b', b'iv', now, 's')], lambda source, entries: delivered.append((source, entries)))
+    assert len(delivered) == 1
+    source, entries = delivered[0]
+    assert source in ('memory', 'rooms')
+    assert [(entry['id'], entry['ciphertext']) for entry in entries] == list(zip(ids, [b'a', b'b']))
+
+def test_delete_room_drops_messages(store):
+    make_room(store, 'r1')
+    now = time.time()
+    store.add_messages([('r1', b'a', b'iv', now, 's')])
+    store.delete_room('r1')
+    assert store.room_salt('r1') is None
+    assert store.recent_messages(['r1'], 0) == []
@@ -0,0 +1,52 @@
+import io
+import os
+import tracemalloc
+
+import app
+
+class Zeros(io.RawIOBase):
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        self.pos = min(offset + (self.size if whence == 2 else self.pos if whence == 1 else 0), self.size)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buf):
+        size = min(len(buf), self.size - self.pos)
+        buf[:size] = b'\0' * size
+        self.pos += size
+        return size
+
+def upload_peak(size, ip):
+    client = app.app.test_client()
+    tracemalloc.start()
+    try:
+        resp = client.post('/api/file/upload?burn_mode=0', input_stream=Zeros(size), headers={'X-Forwarded-For': ip})
+        peak = tracemalloc.get_traced_memory()[1]
+    finally: tracemalloc.stop()
+    assert resp.status_code == 200
+    assert os.path.getsize(app.attachment_path(resp.get_json()['id'])) == size
+    return peak
+
+def test_upload_memory_does_not_grow_with_size():
+    small = upload_peak(1024 * 1024, '203.0.113.1')
+    large = upload_peak(32 * 1024 * 1024, '203.0.113.2')
+    assert large < small + 4 * app.ATTACHMENT_CHUNK
+    assert large < 4 * 1024 * 1024
+
+def test_rejected_options_leave_no_file():
+    before = set(os.listdir(app.ATTACHMENT_DIR))
+    resp = app.app.test_client().post('/api/file/upload?expire_hours=0', data=b'abc', headers={'X-Forwarded-For': '203.0.113.3'})
+    assert resp.status_code == 400
+    assert set(os.listdir(app.ATTACHMENT_DIR)) == before